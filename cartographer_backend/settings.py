@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
 import os
+import tempfile
 
 from . import config
 
@@ -47,12 +48,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'maps.middleware.MetricsMiddleware',
+    'django.middleware.gzip.GZipMiddleware',
+    'maps.middleware.ReplicaMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'maps.middleware.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -76,6 +81,12 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'cartographer_backend.wsgi.application'
+ASGI_APPLICATION = 'cartographer_backend.asgi.application'
+
+# True when the application is served by cartographer_backend/asgi.py, which
+# sets CARTOGRAPHER_ASGI. Views which wait on ArchivesSpace are then routed to
+# their asynchronous versions; under WSGI they use the pooled synchronous client.
+ASGI = os.environ.get('CARTOGRAPHER_ASGI') == 'true'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
@@ -91,9 +102,33 @@ DATABASES = {
         "PASSWORD": config.SQL_PASSWORD,
         "HOST": config.SQL_HOST,
         "PORT": config.SQL_PORT,
+        # Keep connections open between requests, checking them before reuse
+        "CONN_MAX_AGE": 60,
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
+# Read replicas of the default database, as aliases `replica1`, `replica2`
+# and so on. Each is configured by the settings which differ from those of
+# the default database, such as its HOST (or NAME for SQLite). Tests use the
+# default database in their place.
+for index, replica in enumerate(getattr(config, 'SQL_REPLICAS', []), start=1):
+    DATABASES[f"replica{index}"] = {**DATABASES["default"], **replica, "TEST": {"MIRROR": "default"}}
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != "default"]
+DATABASE_ROUTERS = ['maps.routers.ReplicaRouter']
+
+# Seconds for which a client's requests read from the default database after
+# it writes, which should exceed the replication lag, and the cookie which
+# marks such clients
+REPLICA_PIN_SECONDS = 5
+REPLICA_PIN_COOKIE = 'replica_pin'
+
+# Cross-origin frontends send the pin cookie with credentialed requests
+# (CORS_ALLOW_CREDENTIALS), which browsers only do for SameSite=None cookies,
+# and those must be Secure
+REPLICA_PIN_COOKIE_SAMESITE = 'None'
+REPLICA_PIN_COOKIE_SECURE = True
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -136,11 +171,42 @@ STATIC_ROOT = os.path.join(BASE_DIR, "static")
 
 # Django REST Framework
 REST_FRAMEWORK = {
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
+    'DEFAULT_PAGINATION_CLASS': 'maps.pagination.KeysetPagination',
     'PAGE_SIZE': 100
 }
 
+# Maximum number of changes returned by one request to the change feed
+CHANGE_FEED_MAX_LIMIT = 1000
+
 CORS_ALLOWED_ORIGINS = config.DJANGO_CORS_ALLOWED_ORIGINS
+# Allows cross-origin frontends to send cookies, such as REPLICA_PIN_COOKIE
+CORS_ALLOW_CREDENTIALS = True
+
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# The `resources` cache holds ArchivesSpace resource records fetched by
+# ResourceFetcherView. Local memory caches evict the least recently used
+# entries and are not shared between processes; use a shared backend such as
+# Redis or Memcached to share entries between workers.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "resources": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "resources",
+        "TIMEOUT": 86400,
+        "OPTIONS": {"MAX_ENTRIES": 1000},
+    },
+}
+
+# Cache alias for ArchivesSpace resources, and seconds after which a cached
+# resource is revalidated against ArchivesSpace
+RESOURCE_CACHE = "resources"
+RESOURCE_CACHE_REVALIDATE_AFTER = 300
+
+# Store ArrangementMap snapshots zlib-compressed
+COMPRESS_MAP_SNAPSHOTS = True
 
 ASPACE = {
     "baseurl": config.AS_BASEURL,
@@ -148,3 +214,70 @@ ASPACE = {
     "password": config.AS_PASSWORD,
     "repo_id": config.AS_REPO_ID,
 }
+
+# Shared ArchivesSpace client: maximum pooled connections, and connect and
+# read timeouts in seconds
+ASPACE_POOL_SIZE = 10
+ASPACE_CONNECT_TIMEOUT = 5
+ASPACE_READ_TIMEOUT = 60
+
+# Asynchronous ArchivesSpace client used by async views: maximum concurrent
+# requests (and pooled connections) per process, and seconds a request may
+# wait for a free connection
+ASPACE_ASYNC_MAX_CONNECTIONS = 20
+ASPACE_ASYNC_POOL_TIMEOUT = 60
+
+# Maximum number of concurrent requests when updating or searching ArchivesSpace
+ASPACE_MAX_WORKERS = 8
+
+# Seconds for which ArchivesSpace child counts are cached, per resource URI
+CHILD_COUNT_CACHE_TIMEOUT = 3600
+
+# Background jobs: number of attempts before a job is marked as failed, base
+# delay in seconds between retries (doubled after each attempt), seconds after
+# which a running job is assumed to be abandoned, and seconds between polls
+# for new jobs when the queue is empty.
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_BACKOFF = 30
+JOB_TIMEOUT = 3600
+JOB_POLL_INTERVAL = 5
+
+# Days for which tombstones of deleted maps and components are kept by the
+# `compact_tombstones` management command
+TOMBSTONE_RETENTION_DAYS = 365
+
+# Maximum number of URIs accepted by a single batch find-by-uri request
+FIND_BY_URI_MAX_URIS = 500
+
+# Request metrics served at /metrics: upper bounds of histogram buckets for
+# durations (in seconds) and for counts of queries and ArchivesSpace requests
+METRICS_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Request profiling: the URL parameter with which staff users request a
+# profile, the fraction of all requests to profile at random, the directory
+# in which profiles are stored, the number of profiles kept, and the number
+# of SQL statements recorded for each profile
+PROFILE_QUERY_PARAM = 'profile'
+PROFILE_SAMPLE_RATE = 0
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'cartographer-profiles')
+PROFILE_MAX_COUNT = 50
+PROFILE_MAX_QUERIES = 1000
+
+# Per-request metrics are logged as JSON at DEBUG level by maps.middleware,
+# so they are only written if REQUEST_LOG_LEVEL is set to DEBUG in config.py
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'maps.middleware': {
+            'handlers': ['console'],
+            'level': getattr(config, 'REQUEST_LOG_LEVEL', 'WARNING'),
+        },
+    },
+}
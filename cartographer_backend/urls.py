@@ -3,19 +3,34 @@ from django.contrib import admin
 from django.urls import include, path, re_path
 from rest_framework import routers
 
+from cartographer_backend import settings
+from maps.admin import profile_detail, profile_list
 from maps.views import (ArrangementMapComponentViewset, ArrangementMapViewset,
-                        DeletedArrangementMapView, FindByURIView,
+                        AsyncResourceFetcherView, ChangeFeedView,
+                        DeletedArrangementMapView, ExportView,
+                        FindByURIBatchView, FindByURIView, JobViewset,
+                        MetricsView, ResourceCacheStatsView,
                         ResourceFetcherView)
 
+ResourceFetcher = AsyncResourceFetcherView if settings.ASGI else ResourceFetcherView
+
 router = routers.DefaultRouter()
 router.register(r'maps', ArrangementMapViewset, 'arrangementmap')
 router.register(r'components', ArrangementMapComponentViewset, 'arrangementmapcomponent')
+router.register(r'jobs', JobViewset, 'job')
 
 urlpatterns = [
+    path('admin/profiles/', admin.site.admin_view(profile_list), name='profile-list'),
+    path('admin/profiles/<str:name>/', admin.site.admin_view(profile_detail), name='profile-detail'),
     path('admin/', admin.site.urls),
     path('status/', PingView.as_view(), name='ping'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
     path('api/', include(router.urls)),
+    path('api/changes/', ChangeFeedView.as_view(), name='change-feed'),
     path('api/delete-feed/', DeletedArrangementMapView.as_view(), name='delete-feed'),
+    path('api/export/', ExportView.as_view(), name='export'),
+    path('api/find-by-uri/batch/', FindByURIBatchView.as_view(), name='find-by-uri-batch'),
     path('api/find-by-uri/', FindByURIView.as_view(), name='find-by-uri'),
-    re_path(r'api/fetch-resource/(?P<resource_id>\d+)$', ResourceFetcherView.as_view(), name='fetch-resource')
+    path('api/fetch-resource/stats/', ResourceCacheStatsView.as_view(), name='fetch-resource-stats'),
+    re_path(r'api/fetch-resource/(?P<resource_id>\d+)$', ResourceFetcher.as_view(), name='fetch-resource')
 ]
@@ -1,6 +1,9 @@
 from django.contrib import admin
+from django.http import Http404
+from django.template.response import TemplateResponse
 
-from .models import ArrangementMap, DeletedArrangementMap
+from .models import ArrangementMap, Change, DeletedArrangementMap, Job
+from .profiling import list_profiles, load_profile
 
 
 @admin.register(ArrangementMap)
@@ -11,3 +14,31 @@ class ArrangementMapAdmin(admin.ModelAdmin):
 @admin.register(DeletedArrangementMap)
 class DeletedArrangementMapAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(Change)
+class ChangeAdmin(admin.ModelAdmin):
+    list_display = ('sequence', 'action', 'ref', 'created')
+    list_filter = ('action',)
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('task', 'status', 'attempts', 'run_after', 'modified')
+    list_filter = ('status', 'task')
+
+
+def profile_list(request):
+    """Lists stored request profiles, most costly first."""
+    return TemplateResponse(request, 'admin/maps/profile_list.html', {
+        **admin.site.each_context(request), 'title': 'Profiles', 'profiles': list_profiles()})
+
+
+def profile_detail(request, name):
+    """Shows the most costly functions and the queries of a stored request profile."""
+    try:
+        profile = load_profile(name)
+    except (FileNotFoundError, ValueError):
+        raise Http404(f"No profile named {name}.")
+    return TemplateResponse(request, 'admin/maps/profile_detail.html', {
+        **admin.site.each_context(request), 'title': name, 'profile': profile})
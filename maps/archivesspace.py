@@ -0,0 +1,412 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+import httpx
+from asgiref.sync import sync_to_async
+from asnake.client import ASnakeClient
+from django.core.cache import cache, caches
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+from cartographer_backend import settings
+
+from .metrics import render_counter, timer
+
+_client = None
+_async_client = None
+_closing = set()
+_client_lock = threading.Lock()
+
+
+class ArchivesSpaceSession(Session):
+    """Session which applies default timeouts and logs in again when the
+    ArchivesSpace session token has expired."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+        self.client = None
+
+    def request(self, method, url, **kwargs):
+        with timer('archivesspace'):
+            return self.authorized_request(method, url, **kwargs)
+
+    def authorized_request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if not self.client or urlparse(url).path.endswith('/login'):
+            return super(ArchivesSpaceSession, self).request(method, url, **kwargs)
+        token = self.client.token
+        response = super(ArchivesSpaceSession, self).request(method, url, **kwargs)
+        if response.status_code in (401, 412):
+            self.client.reauthorize(token)
+            response = super(ArchivesSpaceSession, self).request(method, url, **kwargs)
+        return response
+
+
+class ArchivesSpaceClient(ASnakeClient):
+    """ASnakeClient which can be shared between threads.
+
+    Keep-alive connections are pooled, up to `pool_size` per host. The session
+    token is reused until ArchivesSpace reports that it has expired, at which
+    point the client logs in again once, no matter how many threads saw the
+    expired token.
+    """
+
+    def __init__(self, pool_size=10, timeout=None, **config):
+        self.session = ArchivesSpaceSession(timeout)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.client = self
+        self.logins = 0
+        self.auth_lock = threading.Lock()
+        super(ArchivesSpaceClient, self).__init__(**config)
+
+    def authorize(self, *args, **kwargs):
+        self.logins += 1
+        return super(ArchivesSpaceClient, self).authorize(*args, **kwargs)
+
+    @property
+    def token(self):
+        return self.session.headers.get(self.config['session_header_name'])
+
+    def reauthorize(self, expired_token):
+        """Logs in again unless another thread already replaced the expired token."""
+        with self.auth_lock:
+            if self.token == expired_token:
+                self.authorize()
+
+    @property
+    def stats(self):
+        """Returns counts of logins, requests and connections opened.
+
+        Requests which did not need a new connection reused a pooled one.
+        """
+        pools = [adapter.poolmanager.pools.get(key) for adapter in set(self.session.adapters.values())
+                 for key in adapter.poolmanager.pools.keys()]
+        pools = [pool for pool in pools if pool]
+        requests = sum(pool.num_requests for pool in pools)
+        connections = sum(pool.num_connections for pool in pools)
+        return {
+            "logins": self.logins,
+            "requests": requests,
+            "connections": connections,
+            "reused_connections": requests - connections,
+        }
+
+
+def get_client():
+    """Returns the ArchivesSpace client for this process, creating and
+    authorizing it on first use.
+
+    A new client is created if the process has forked or the ArchivesSpace
+    settings have changed since the client was created.
+    """
+    global _client
+    key = (os.getpid(), settings.ASPACE['baseurl'], settings.ASPACE['username'], settings.ASPACE['password'])
+    with _client_lock:
+        if _client is None or _client.key != key:
+            client = ArchivesSpaceClient(
+                pool_size=settings.ASPACE_POOL_SIZE,
+                timeout=(settings.ASPACE_CONNECT_TIMEOUT, settings.ASPACE_READ_TIMEOUT),
+                baseurl=settings.ASPACE['baseurl'],
+                username=settings.ASPACE['username'],
+                password=settings.ASPACE['password'])
+            client.authorize()
+            client.key = key
+            _client = client
+        return _client
+
+
+def client_metrics():
+    """Returns the logins, requests and connections opened by this process's
+    ArchivesSpace client as Prometheus counters, or no lines if it has not
+    been created. Requests which did not open a connection reused one."""
+    if _client is None:
+        return []
+    stats = _client.stats
+    return [
+        *render_counter(
+            'cartographer_archivesspace_logins_total', 'Logins by the ArchivesSpace client.', stats['logins']),
+        *render_counter(
+            'cartographer_archivesspace_client_requests_total', 'Requests made by the ArchivesSpace client.',
+            stats['requests']),
+        *render_counter(
+            'cartographer_archivesspace_connections_total', 'Connections opened by the ArchivesSpace client.',
+            stats['connections']),
+    ]
+
+
+class AsyncArchivesSpaceClient:
+    """Non-blocking ArchivesSpace client for async views.
+
+    Keep-alive connections are pooled, and at most `max_connections` requests
+    are made at once; other requests wait for a connection to become free
+    without holding a thread. As with ArchivesSpaceClient, the session token
+    is reused until ArchivesSpace reports that it has expired, at which point
+    the client logs in again once. A client can only be used from the event
+    loop in which it was created.
+    """
+
+    session_header_name = 'X-ArchivesSpace-Session'
+
+    def __init__(self, baseurl, username, password, max_connections=10, timeout=None):
+        self.username = username
+        self.password = password
+        self.session = httpx.AsyncClient(
+            base_url=baseurl, timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+        self.logins = 0
+        self.auth_lock = asyncio.Lock()
+
+    @property
+    def token(self):
+        return self.session.headers.get(self.session_header_name)
+
+    async def send(self, method, url, **kwargs):
+        with timer('archivesspace'):
+            return await self.session.request(method, url, **kwargs)
+
+    async def authorize(self):
+        self.logins += 1
+        response = await self.send('POST', f'users/{self.username}/login', params={'password': self.password})
+        response.raise_for_status()
+        self.session.headers[self.session_header_name] = response.json()['session']
+
+    async def reauthorize(self, expired_token):
+        """Logs in again unless another task already replaced the expired token."""
+        async with self.auth_lock:
+            if self.token == expired_token:
+                await self.authorize()
+
+    async def request(self, method, url, **kwargs):
+        if not self.token:
+            await self.reauthorize(None)
+        token = self.token
+        response = await self.send(method, url, **kwargs)
+        if response.status_code in (401, 412):
+            await self.reauthorize(token)
+            response = await self.send(method, url, **kwargs)
+        return response
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+
+def get_async_client():
+    """Returns the asynchronous ArchivesSpace client for the running event
+    loop, creating it on first use. The client logs in when it first makes a
+    request.
+
+    A new client is created if the event loop has changed, the process has
+    forked or the ArchivesSpace settings have changed since the client was
+    created. A client replacing one for another event loop keeps its session
+    token, so that it does not need to log in again, and the replaced
+    client's connections are closed.
+
+    Under ASGI there is one event loop per process. Under WSGI each async view
+    runs in its own event loop, so WSGI deployments use get_client instead.
+    """
+    global _async_client
+    loop = asyncio.get_running_loop()
+    key = (os.getpid(), settings.ASPACE['baseurl'], settings.ASPACE['username'], settings.ASPACE['password'])
+    with _client_lock:
+        if _async_client is None or _async_client.key != key or _async_client.loop is not loop:
+            client = AsyncArchivesSpaceClient(
+                settings.ASPACE['baseurl'], settings.ASPACE['username'], settings.ASPACE['password'],
+                max_connections=settings.ASPACE_ASYNC_MAX_CONNECTIONS,
+                timeout=httpx.Timeout(
+                    settings.ASPACE_READ_TIMEOUT, connect=settings.ASPACE_CONNECT_TIMEOUT,
+                    pool=settings.ASPACE_ASYNC_POOL_TIMEOUT))
+            if _async_client is not None:
+                if _async_client.key == key and _async_client.token:
+                    client.session.headers[client.session_header_name] = _async_client.token
+                close_async_client(_async_client)
+            client.key, client.loop = key, loop
+            _async_client = client
+        return _async_client
+
+
+def close_async_client(client):
+    """Closes the connections of an asynchronous client from its own event
+    loop. If that loop has already been closed, the connections are released
+    when the client is garbage collected."""
+    if client.loop.is_closed():
+        return
+    if client.loop is asyncio.get_running_loop():
+        task = client.loop.create_task(client.session.aclose())
+        _closing.add(task)
+        task.add_done_callback(_closing.discard)
+    else:
+        asyncio.run_coroutine_threadsafe(client.session.aclose(), client.loop)
+
+
+def set_publish(client, uri, publish):
+    """Sets the publish flag of an ArchivesSpace record.
+
+    Returns `unchanged` if the record already had the requested value, otherwise
+    `updated`.
+    """
+    response = client.get(uri)
+    response.raise_for_status()
+    resource = response.json()
+    if resource.get("publish") == publish:
+        return "unchanged"
+    resource["publish"] = publish
+    client.post(uri, json=resource).raise_for_status()
+    return "updated"
+
+
+def propagate_publish(client, uris, publish, max_workers=None, progress=None):
+    """Sets the publish flag on ArchivesSpace records using a bounded pool of workers.
+
+    Duplicate and empty URIs are ignored. All workers share the session of the
+    supplied client. Failures for one URI do not stop updates to the others.
+    If supplied, `progress` is called with the number of completed and total
+    records each time a record is finished.
+
+    Returns a dict keyed by URI, with a `status` of `updated`, `unchanged` or
+    `error` (along with an `error` message) for each record.
+    """
+    uris = sorted(set(uri for uri in uris if uri))
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers or settings.ASPACE_MAX_WORKERS) as executor:
+        futures = {executor.submit(set_publish, client, uri, publish): uri for uri in uris}
+        for future in as_completed(futures):
+            uri = futures[future]
+            try:
+                results[uri] = {"status": future.result()}
+            except Exception as e:
+                results[uri] = {"status": "error", "error": str(e)}
+            if progress:
+                progress(len(results), len(uris))
+    return dict(sorted(results.items()))
+
+
+def get_child_count(client, uri):
+    """Returns the number of published archival objects in an ArchivesSpace resource."""
+    escaped_uri = uri.replace('/', r'\/')
+    search_uri = f"search?q=resource:/{escaped_uri}/ AND publish:true&page=1&fields[]=uri&type[]=archival_object&page_size=1"
+    response = client.get(search_uri)
+    response.raise_for_status()
+    return response.json()["total_hits"]
+
+
+def get_child_counts(client, uris, max_workers=None):
+    """Returns child counts for ArchivesSpace resources, keyed by URI.
+
+    Counts are cached for CHILD_COUNT_CACHE_TIMEOUT seconds. URIs which are not
+    cached are looked up concurrently using a bounded pool of workers sharing
+    the session of the supplied client.
+    """
+    keys = {uri: f"child-count:{uri}" for uri in set(uri for uri in uris if uri)}
+    cached = cache.get_many(keys.values())
+    counts = {uri: cached[key] for uri, key in keys.items() if key in cached}
+    missing = sorted(uri for uri in keys if uri not in counts)
+    with ThreadPoolExecutor(max_workers=max_workers or settings.ASPACE_MAX_WORKERS) as executor:
+        fetched = dict(zip(missing, executor.map(lambda uri: get_child_count(client, uri), missing)))
+    cache.set_many({keys[uri]: count for uri, count in fetched.items()}, settings.CHILD_COUNT_CACHE_TIMEOUT)
+    return dict(sorted({**counts, **fetched}.items()))
+
+
+def get_system_mtime(client, uri):
+    """Returns the last modified time of an ArchivesSpace record from the search
+    index, which is much cheaper than fetching the record itself."""
+    response = client.get('search', params=system_mtime_params(uri))
+    response.raise_for_status()
+    results = response.json().get('results')
+    return results[0].get('system_mtime') if results else None
+
+
+async def aget_system_mtime(client, uri):
+    """Asynchronous version of get_system_mtime."""
+    response = await client.get('search', params=system_mtime_params(uri))
+    response.raise_for_status()
+    results = response.json().get('results')
+    return results[0].get('system_mtime') if results else None
+
+
+def system_mtime_params(uri):
+    return {'q': f'id:"{uri}"', 'page': 1, 'page_size': 1, 'fields': ['uri', 'system_mtime']}
+
+
+def increment_resource_stat(name):
+    resource_cache = caches[settings.RESOURCE_CACHE]
+    key = f"resource-stats:{name}"
+    resource_cache.add(key, 0, None)
+    try:
+        resource_cache.incr(key)
+    except ValueError:
+        resource_cache.set(key, 1, None)
+
+
+def resource_cache_stats():
+    """Returns the number of cache hits, revalidated hits and misses for resources."""
+    names = ("hits", "revalidated", "misses")
+    stats = caches[settings.RESOURCE_CACHE].get_many([f"resource-stats:{name}" for name in names])
+    return {name: stats.get(f"resource-stats:{name}", 0) for name in names}
+
+
+def fetch_resource(resource_id, refresh=False):
+    """Fetches an ArchivesSpace resource record, using a cache where possible.
+
+    Cached records are used without checking ArchivesSpace for
+    RESOURCE_CACHE_REVALIDATE_AFTER seconds. After that they are revalidated
+    against the `system_mtime` in the search index, and only fetched again if
+    the record has changed. Records are evicted from the cache after its
+    TIMEOUT, or by the cache backend's eviction policy. If `refresh` is true
+    the record is always fetched.
+
+    Returns a tuple of the HTTP status code, the response body and one of
+    `HIT`, `REVALIDATED` or `MISS`.
+    """
+    resource_cache = caches[settings.RESOURCE_CACHE]
+    client = get_client()
+    uri = f"/repositories/{settings.ASPACE['repo_id']}/resources/{resource_id}"
+    key = f"resource:{uri}"
+    entry = None if refresh else resource_cache.get(key)
+    if entry:
+        if time.time() - entry["validated"] < settings.RESOURCE_CACHE_REVALIDATE_AFTER:
+            increment_resource_stat("hits")
+            return 200, entry["resource"], "HIT"
+        if get_system_mtime(client, uri) == entry["resource"].get("system_mtime"):
+            entry["validated"] = time.time()
+            resource_cache.set(key, entry)
+            increment_resource_stat("revalidated")
+            return 200, entry["resource"], "REVALIDATED"
+    increment_resource_stat("misses")
+    response = client.get(uri)
+    if response.status_code == 200:
+        resource_cache.set(key, {"resource": response.json(), "validated": time.time()})
+    return response.status_code, response.json(), "MISS"
+
+
+async def afetch_resource(resource_id, refresh=False):
+    """Asynchronous version of fetch_resource, for use under ASGI.
+
+    ArchivesSpace is called with the asynchronous client, so waiting for it
+    does not hold a thread.
+    """
+    resource_cache = caches[settings.RESOURCE_CACHE]
+    client = get_async_client()
+    uri = f"/repositories/{settings.ASPACE['repo_id']}/resources/{resource_id}"
+    key = f"resource:{uri}"
+    entry = None if refresh else await resource_cache.aget(key)
+    if entry:
+        if time.time() - entry["validated"] < settings.RESOURCE_CACHE_REVALIDATE_AFTER:
+            await sync_to_async(increment_resource_stat)("hits")
+            return 200, entry["resource"], "HIT"
+        if await aget_system_mtime(client, uri) == entry["resource"].get("system_mtime"):
+            entry["validated"] = time.time()
+            await resource_cache.aset(key, entry)
+            await sync_to_async(increment_resource_stat)("revalidated")
+            return 200, entry["resource"], "REVALIDATED"
+    await sync_to_async(increment_resource_stat)("misses")
+    response = await client.get(uri)
+    if response.status_code == 200:
+        await resource_cache.aset(key, {"resource": response.json(), "validated": time.time()})
+    return response.status_code, response.json(), "MISS"
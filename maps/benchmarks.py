@@ -0,0 +1,188 @@
+import gzip
+import time
+from statistics import mean
+from unittest.mock import patch
+
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from rest_framework.renderers import JSONRenderer
+
+from cartographer_backend import settings
+
+from .jobs import enqueue, run_job
+from .models import (ArrangementMap, ArrangementMapComponent,
+                     DeletedArrangementMap)
+from .pagination import KeysetPagination
+from .serializers import (ArrangementMapCompactSerializer,
+                          ArrangementMapComponentBulkSerializer,
+                          ArrangementMapSerializer)
+from .testing import ArchivesSpaceStub
+
+URI_COUNT = 50
+
+
+def get_uri(index):
+    return f"/repositories/2/resources/{index % URI_COUNT + 1}"
+
+
+def build_map(title, size, depth, fanout):
+    """Creates an ArrangementMap with `size` components, breadth first, in
+    levels of up to `fanout` children per component and at most `depth`
+    levels deep."""
+    map = ArrangementMap.objects.create(title=title)
+    items = []
+    parents = [None]
+    for _ in range(depth):
+        children = []
+        for parent in parents:
+            for order in range(fanout):
+                if len(items) == size:
+                    break
+                key = str(len(items))
+                items.append({
+                    'key': key, 'parent_key': parent, 'map': map.pk, 'title': f"{title} {key}",
+                    'order': order, 'archivesspace_uri': get_uri(len(items))})
+                children.append(key)
+        parents = children
+    for item in items:
+        if item['parent_key'] is None:
+            del item['parent_key']
+    serializer = ArrangementMapComponentBulkSerializer(data=items, many=True)
+    serializer.is_valid(raise_exception=True)
+    serializer.save()
+    return map
+
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of a list of values."""
+    values = sorted(values)
+    return values[max(0, -(-len(values) * percent // 100) - 1)]
+
+
+def summarize(timings, queries):
+    """Returns latency percentiles in milliseconds and query counts for a
+    list of timed runs."""
+    timings = [t * 1000 for t in timings]
+    return {
+        'runs': len(timings),
+        'latency_ms': {
+            'mean': round(mean(timings), 3),
+            'p50': round(percentile(timings, 50), 3),
+            'p90': round(percentile(timings, 90), 3),
+            'p99': round(percentile(timings, 99), 3),
+            'max': round(max(timings), 3),
+        },
+        'queries': {'min': min(queries), 'max': max(queries)},
+    }
+
+
+def measure(func, iterations):
+    """Runs a function once to warm up and then `iterations` times, returning
+    a summary of its latency and the number of queries it made."""
+    func()
+    timings, queries = [], []
+    for _ in range(iterations):
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        queries.append(len(captured))
+    return summarize(timings, queries)
+
+
+def get_scenarios(client, map, component):
+    """Returns the requests to benchmark, keyed by name."""
+    def get(path):
+        def request():
+            response = client.get(path)
+            if response.status_code != 200:
+                raise Exception(f"{path} returned {response.status_code}")
+            if response.streaming:
+                b"".join(response.streaming_content)
+        return request
+
+    uris = "&".join(f"uri={get_uri(i)}" for i in range(URI_COUNT))
+    delete_feed = reverse('delete-feed')
+    # The last page of tombstones, reached by offset and by cursor
+    page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
+    offset = max(DeletedArrangementMap.objects.count() - page_size, 0)
+    pagination = KeysetPagination()
+    pagination.field = DeletedArrangementMap._meta.get_field('deleted')
+    before_last_page = DeletedArrangementMap.objects.order_by('deleted', 'pk')[offset - 1] if offset else None
+    cursor = pagination.encode_cursor(before_last_page) if before_last_page else ''
+    return {
+        'map_list': get(reverse('arrangementmap-list')),
+        'map_detail': get(reverse('arrangementmap-detail', kwargs={'pk': map.pk})),
+        'map_detail_compact': get(f"{reverse('arrangementmap-detail', kwargs={'pk': map.pk})}?format=compact"),
+        'map_objects_before': get(reverse('arrangementmap-objects-before', kwargs={'pk': map.pk})),
+        'component_list': get(reverse('arrangementmapcomponent-list')),
+        'component_list_cursor': get(f"{reverse('arrangementmapcomponent-list')}?cursor="),
+        'component_detail': get(reverse('arrangementmapcomponent-detail', kwargs={'pk': component.pk})),
+        'component_objects_before': get(
+            reverse('arrangementmapcomponent-objects-before', kwargs={'pk': component.pk})),
+        'find_by_uri': get(f"{reverse('find-by-uri')}?uri={component.archivesspace_uri}"),
+        'find_by_uri_batch': get(f"{reverse('find-by-uri-batch')}?{uris}"),
+        'export': get(reverse('export')),
+        'delete_feed': get(delete_feed),
+        'delete_feed_last_page': get(f"{delete_feed}?offset={offset}"),
+        'delete_feed_cursor': get(f"{delete_feed}?cursor="),
+        'delete_feed_cursor_last_page': get(f"{delete_feed}?cursor={cursor}"),
+    }
+
+
+def compare_formats(map, iterations):
+    """Returns the time taken to serialize and render a map in the nested and
+    compact formats, and the size of each, uncompressed and gzipped."""
+    results = {}
+    for name, serializer_class in [('nested', ArrangementMapSerializer), ('compact', ArrangementMapCompactSerializer)]:
+        def render():
+            return JSONRenderer().render(serializer_class(map).data)
+        results[name] = measure(render, iterations)
+        content = render()
+        results[name].update(bytes=len(content), gzip_bytes=len(gzip.compress(content)))
+    return results
+
+
+def run_benchmark(maps=3, size=500, depth=4, fanout=8, iterations=20, latency=0.0):
+    """Benchmarks API requests and ArchivesSpace publishing against synthetic maps.
+
+    Maps are created in a transaction which is rolled back afterwards, and
+    ArchivesSpace is replaced by a local stub which waits `latency` seconds
+    before each response. A further map is built and deleted, so that the
+    delete feed has a map's worth of tombstones to page through. Returns the
+    parameters and a summary for each scenario, including a comparison of
+    the nested and compact map formats.
+    """
+    parameters = {
+        'maps': maps, 'size': size, 'depth': depth, 'fanout': fanout,
+        'iterations': iterations, 'latency': latency}
+    results = {}
+    records = {get_uri(i): {'uri': get_uri(i), 'publish': False} for i in range(URI_COUNT)}
+    with transaction.atomic(), override_settings(ALLOWED_HOSTS=['testserver']), \
+            ArchivesSpaceStub(records=records, latency=latency) as stub, \
+            patch.dict(settings.ASPACE, {'baseurl': stub.baseurl}):
+        start = time.perf_counter()
+        built = [build_map(f"Benchmark {i}", size, depth, fanout) for i in range(maps)]
+        ArrangementMap.objects.filter(pk__in=[m.pk for m in built]).update(publish=True)
+        results['build_maps'] = {'seconds': round(time.perf_counter() - start, 3)}
+        start = time.perf_counter()
+        build_map("Benchmark deleted", size, depth, fanout).delete()
+        results['delete_map'] = {'seconds': round(time.perf_counter() - start, 3)}
+        map = built[0]
+        component = ArrangementMapComponent.objects.filter(map=map).order_by('-level', '-tree_index').first()
+
+        for name, func in get_scenarios(Client(), map, component).items():
+            results[name] = measure(func, iterations)
+        results['map_formats'] = compare_formats(map, iterations)
+
+        def publish():
+            job = run_job(enqueue('publish_map', map_id=map.pk))
+            if job.status != job.SUCCEEDED:
+                raise Exception(f"Publishing failed: {job.error}")
+        requests = len(stub.requests)
+        results['publish_map'] = measure(publish, iterations)
+        results['publish_map']['archivesspace_requests'] = round((len(stub.requests) - requests) / (iterations + 1), 1)
+        transaction.set_rollback(True)
+    return {'parameters': parameters, 'results': results}
@@ -0,0 +1,42 @@
+from django.db import connection, transaction
+from django.urls import reverse
+
+from .models import ArrangementMap, Change
+
+# Key of the advisory lock held while appending to the change log
+CHANGE_LOG_LOCK = 7346001
+
+
+def get_ref(model, pk):
+    """Returns the API path of an ArrangementMap or ArrangementMapComponent."""
+    view = 'arrangementmap-detail' if model is ArrangementMap else 'arrangementmapcomponent-detail'
+    return reverse(view, kwargs={'pk': pk})
+
+
+def get_change(action, instance):
+    """Returns an unsaved Change recording an action on an instance."""
+    return Change(
+        action=action, ref=get_ref(type(instance), instance.pk),
+        archivesspace_uri=getattr(instance, 'archivesspace_uri', None))
+
+
+def record_changes(changes):
+    """Appends Changes to the log with a single insert, in the same
+    transaction as the writes they record, so that a change is logged if and
+    only if its write is committed.
+
+    On PostgreSQL the insert first takes an advisory lock, held until the
+    transaction commits, so that sequence numbers become visible in the order
+    they were assigned and a consumer resuming from the last sequence it has
+    seen never skips a change which was committed later with a lower number.
+    Unlike a table lock, it does not conflict with vacuuming or other access
+    to the log. Writers are only serialized from their first logged change
+    to their commit, so batched writes log their changes at the end.
+    """
+    if not changes:
+        return
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [CHANGE_LOG_LOCK])
+        Change.objects.bulk_create(changes)
@@ -0,0 +1,172 @@
+import threading
+import weakref
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from cartographer_backend import settings
+
+from .archivesspace import get_child_counts, get_client, propagate_publish
+from .changes import get_ref, record_changes
+from .models import (ArrangementMap, ArrangementMapComponent,
+                     ArrangementMapSnapshot, Change, Job)
+
+TASKS = {}
+
+_pending_child_counts = threading.local()
+
+
+def task(func):
+    """Registers a function as a task which can be run as a Job.
+
+    Tasks are called with the Job and the keyword arguments it was enqueued
+    with, and return a JSON-serializable result.
+    """
+    TASKS[func.__name__] = func
+    return func
+
+
+def enqueue(task_name, **arguments):
+    """Creates a pending Job for a registered task."""
+    if task_name not in TASKS:
+        raise ValueError(f"Unknown task {task_name}")
+    return Job.objects.create(task=task_name, arguments=arguments, max_attempts=settings.JOB_MAX_ATTEMPTS)
+
+
+def claim_job():
+    """Marks the next runnable Job as running and returns it.
+
+    Jobs which have been running for longer than JOB_TIMEOUT are assumed to
+    belong to a worker which has died, and are claimed again.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        job = Job.objects.select_for_update(skip_locked=True).filter(
+            status__in=[Job.PENDING, Job.RUNNING], run_after__lte=now).order_by('run_after', 'pk').first()
+        if job:
+            job.status = Job.RUNNING
+            job.attempts += 1
+            job.run_after = now + timedelta(seconds=settings.JOB_TIMEOUT)
+            job.save()
+    return job
+
+
+def run_job(job):
+    """Runs a claimed Job, scheduling a retry with exponential backoff if it fails."""
+    try:
+        job.result = TASKS[job.task](job, **job.arguments)
+        job.status = Job.SUCCEEDED
+        job.error = ''
+    except Exception as e:
+        job.error = str(e)
+        if job.attempts < job.max_attempts:
+            job.status = Job.PENDING
+            job.run_after = timezone.now() + timedelta(seconds=settings.JOB_RETRY_BACKOFF * 2 ** (job.attempts - 1))
+        else:
+            job.status = Job.FAILED
+    job.save()
+    return job
+
+
+def set_progress(job, completed, total):
+    job.progress = {"completed": completed, "total": total}
+    Job.objects.filter(pk=job.pk).update(progress=job.progress)
+
+
+@task
+def publish_map(job, map_id):
+    """Sets the publish status of every ArchivesSpace record in a map to
+    match the map."""
+    map = ArrangementMap.objects.get(pk=map_id)
+    uris = ArrangementMapComponent.objects.filter(map=map).values_list('archivesspace_uri', flat=True).distinct()
+    job.result = propagate_publish(
+        get_client(), uris, map.publish,
+        progress=lambda completed, total: set_progress(job, completed, total))
+    failed = [uri for uri, result in job.result.items() if result["status"] == "error"]
+    if failed:
+        raise Exception(f"Error handling publish action in ArchivesSpace for {', '.join(failed)}")
+    return job.result
+
+
+@task
+def update_child_counts(job, component_ids):
+    """Sets the child count of ArrangementMapComponents from the number of
+    published archival objects in their ArchivesSpace resources.
+
+    Each distinct URI is looked up once. Components whose count differs have
+    their `modified` time updated and a Change logged, and their maps are
+    saved so that validators and snapshots derived from the map change too.
+    """
+    component_ids_by_uri = defaultdict(list)
+    for pk, uri in ArrangementMapComponent.objects.filter(
+            pk__in=component_ids, archivesspace_uri__isnull=False).values_list('pk', 'archivesspace_uri'):
+        component_ids_by_uri[uri].append(pk)
+    counts = get_child_counts(get_client(), component_ids_by_uri)
+    with transaction.atomic():
+        changes = []
+        map_ids = set()
+        for uri, child_count in counts.items():
+            components = ArrangementMapComponent.objects.filter(
+                pk__in=component_ids_by_uri[uri]).exclude(child_count=child_count)
+            for pk, map_id in components.values_list('pk', 'map_id'):
+                changes.append(
+                    Change(action=Change.UPDATE, ref=get_ref(ArrangementMapComponent, pk), archivesspace_uri=uri))
+                map_ids.add(map_id)
+            components.update(child_count=child_count, modified=timezone.now())
+        record_changes(changes)
+        ArrangementMapSnapshot.objects.filter(map_id__in=map_ids).delete()
+        for map in ArrangementMap.objects.filter(pk__in=map_ids):
+            map.save()
+    return counts
+
+
+class PendingChildCounts(set):
+    """Ids of components whose child counts should be updated once the
+    current transaction on a database connection commits."""
+
+    def __init__(self, using):
+        super(PendingChildCounts, self).__init__()
+        self.using = using
+
+    def __call__(self):
+        if get_pending_child_counts(self.using) is self:
+            del _pending_child_counts.__dict__[self.using]
+        if self:
+            enqueue('update_child_counts', component_ids=sorted(self))
+
+
+def get_pending_child_counts(using):
+    """Returns the pending child counts of the current transaction on a
+    connection, if any.
+
+    Only a weak reference is kept: the pending counts are referenced by the
+    transaction's on_commit callbacks, so they are released when the
+    transaction is rolled back.
+    """
+    ref = _pending_child_counts.__dict__.get(using)
+    return ref() if ref else None
+
+
+def schedule_child_count(component_id):
+    """Schedules an update of a component's child count.
+
+    Outside a transaction a Job is enqueued at once. Within a transaction the
+    component is added to the pending child counts of the transaction, and
+    once it commits all of them are updated by a single `update_child_counts`
+    Job. If the transaction is rolled back, its pending components are
+    discarded along with its other on_commit callbacks.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        enqueue('update_child_counts', component_ids=[component_id])
+        return
+    pending = get_pending_child_counts(connection.alias)
+    if pending is None:
+        pending = PendingChildCounts(connection.alias)
+        pending.add(component_id)
+        transaction.on_commit(pending)
+        _pending_child_counts.__dict__[connection.alias] = weakref.ref(pending)
+    else:
+        pending.add(component_id)
@@ -0,0 +1,29 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from maps.benchmarks import run_benchmark
+
+
+class Command(BaseCommand):
+    help = "Benchmarks API requests and ArchivesSpace publishing against synthetic ArrangementMaps."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--maps', type=int, default=3, help="Number of maps to create.")
+        parser.add_argument('--size', type=int, default=500, help="Number of components in each map.")
+        parser.add_argument('--depth', type=int, default=4, help="Maximum depth of each map's tree.")
+        parser.add_argument('--fanout', type=int, default=8, help="Maximum number of children of each component.")
+        parser.add_argument('--iterations', type=int, default=20, help="Number of times each request is timed.")
+        parser.add_argument(
+            '--latency', type=float, default=0.0, help="Seconds the ArchivesSpace stub waits before responding.")
+        parser.add_argument('--output', help="File to write results to. Defaults to standard output.")
+
+    def handle(self, *args, **options):
+        results = run_benchmark(
+            maps=options['maps'], size=options['size'], depth=options['depth'], fanout=options['fanout'],
+            iterations=options['iterations'], latency=options['latency'])
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+        else:
+            self.stdout.write(json.dumps(results, indent=2))
@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.utils import timezone
+
+from cartographer_backend import settings
+from maps.models import DeletedArrangementMap
+
+
+class Command(BaseCommand):
+    help = "Removes superseded and expired DeletedArrangementMap objects."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.TOMBSTONE_RETENTION_DAYS,
+            help="Remove tombstones older than this many days.")
+
+    def handle(self, *args, **options):
+        latest = DeletedArrangementMap.objects.values('ref').annotate(latest=Max('pk')).values('latest')
+        superseded, _ = DeletedArrangementMap.objects.exclude(pk__in=latest).delete()
+        expired, _ = DeletedArrangementMap.objects.filter(
+            deleted__lt=timezone.now() - timedelta(days=options['days'])).delete()
+        self.stdout.write(f"Removed {superseded} superseded and {expired} expired DeletedArrangementMap objects.")
@@ -0,0 +1,27 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import make_aware
+
+from maps.snapshots import export_maps
+
+
+class Command(BaseCommand):
+    help = "Exports all published ArrangementMaps as newline-delimited JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--modified-since', type=int, default=0,
+            help="Only export maps modified since this time (as a Unix timestamp).")
+        parser.add_argument(
+            '--output', help="File to write the export to. Defaults to standard output.")
+
+    def handle(self, *args, **options):
+        modified_since = make_aware(datetime.fromtimestamp(options['modified_since']))
+        lines = export_maps(modified_since)
+        if options['output']:
+            with open(options['output'], 'wb') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line.decode(), ending='')
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from cartographer_backend import settings
+from maps.jobs import claim_job, run_job
+
+
+class Command(BaseCommand):
+    help = "Runs background jobs, polling the database for new jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--burst', action='store_true',
+            help="Exit once there are no runnable jobs instead of polling.")
+
+    def handle(self, *args, **options):
+        while True:
+            job = claim_job()
+            if not job:
+                if options['burst']:
+                    return
+                time.sleep(settings.JOB_POLL_INTERVAL)
+                continue
+            run_job(job)
+            self.stdout.write(f"Job {job.pk} ({job.task}) {job.status} after {job.attempts} attempt(s).")
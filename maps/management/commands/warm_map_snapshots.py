@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from maps.models import ArrangementMap
+from maps.snapshots import build_snapshot
+
+
+class Command(BaseCommand):
+    help = "Builds stored snapshots for all ArrangementMaps."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--stale-only', action='store_true',
+            help="Only rebuild snapshots which are missing or out of date.")
+
+    def handle(self, *args, **options):
+        count = 0
+        for map in ArrangementMap.objects.select_related('snapshot').iterator(chunk_size=100):
+            if options['stale_only'] and hasattr(map, 'snapshot') and map.snapshot.is_current:
+                continue
+            build_snapshot(map)
+            count += 1
+        self.stdout.write(f"Built {count} ArrangementMap snapshots.")
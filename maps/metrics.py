@@ -0,0 +1,151 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+
+from cartographer_backend import settings
+
+_metrics = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """Counts and durations, in seconds, of work done while handling a request."""
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.durations = defaultdict(float)
+        self.active = set()
+
+
+def get_request_metrics():
+    """Returns the metrics of the request being handled in this context, if any."""
+    return _metrics.get()
+
+
+@contextmanager
+def collect():
+    """Collects metrics for the work done within a block.
+
+    Metrics are kept in a context variable, so concurrent requests handled by
+    one event loop are kept apart, and work which asgiref runs in another
+    thread on behalf of the request is included.
+    """
+    token = _metrics.set(RequestMetrics())
+    try:
+        yield _metrics.get()
+    finally:
+        _metrics.reset(token)
+
+
+@contextmanager
+def timer(name):
+    """Adds the duration of a block to the named metric of the current request,
+    and one to its count.
+
+    Blocks nested within a block for the same metric are not counted again.
+    """
+    metrics = get_request_metrics()
+    if metrics is None or name in metrics.active:
+        yield
+        return
+    metrics.active.add(name)
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        metrics.durations[name] += perf_counter() - start
+        metrics.counts[name] += 1
+        metrics.active.discard(name)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper which times queries.
+
+    It is added to every connection when it is opened, so queries are timed
+    in whichever thread the request uses the database.
+    """
+    with timer('db'):
+        return execute(sql, params, many, context)
+
+
+class TimedDataMixin:
+    """Serializer mixin which times building the serialized data."""
+
+    @property
+    def data(self):
+        with timer('serialize'):
+            return super(TimedDataMixin, self).data
+
+
+class Histogram:
+    """A Prometheus histogram, with observations grouped by label values."""
+
+    def __init__(self, name, description, buckets, labels=('view', 'method')):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        with self.lock:
+            counts, total, observations = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            counts = [count + (value <= bucket) for count, bucket in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, observations + 1)
+
+    def render(self):
+        """Returns the histogram in the Prometheus text exposition format."""
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, (counts, total, observations) in values:
+            labels = ','.join(f'{label}="{value}"' for label, value in zip(self.labels, key))
+            for bucket, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bucket}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {observations}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {observations}')
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    'cartographer_request_duration_seconds', 'Time taken to handle requests.', settings.METRICS_DURATION_BUCKETS)
+DB_DURATION = Histogram(
+    'cartographer_db_duration_seconds', 'Time spent in database queries per request.',
+    settings.METRICS_DURATION_BUCKETS)
+DB_QUERIES = Histogram(
+    'cartographer_db_queries', 'Database queries made per request.', settings.METRICS_COUNT_BUCKETS)
+ASPACE_DURATION = Histogram(
+    'cartographer_archivesspace_duration_seconds', 'Time spent in ArchivesSpace requests per request.',
+    settings.METRICS_DURATION_BUCKETS)
+ASPACE_REQUESTS = Histogram(
+    'cartographer_archivesspace_requests', 'ArchivesSpace requests made per request.',
+    settings.METRICS_COUNT_BUCKETS)
+SERIALIZE_DURATION = Histogram(
+    'cartographer_serialize_duration_seconds', 'Time spent serializing and rendering response data per request.',
+    settings.METRICS_DURATION_BUCKETS)
+HISTOGRAMS = [REQUEST_DURATION, DB_DURATION, DB_QUERIES, ASPACE_DURATION, ASPACE_REQUESTS, SERIALIZE_DURATION]
+
+
+def observe_request(metrics, duration, **labels):
+    """Adds the metrics of a handled request to the histograms."""
+    REQUEST_DURATION.observe(duration, **labels)
+    DB_DURATION.observe(metrics.durations['db'], **labels)
+    DB_QUERIES.observe(metrics.counts['db'], **labels)
+    ASPACE_DURATION.observe(metrics.durations['archivesspace'], **labels)
+    ASPACE_REQUESTS.observe(metrics.counts['archivesspace'], **labels)
+    SERIALIZE_DURATION.observe(metrics.durations['serialize'] + metrics.durations['render'], **labels)
+
+
+def render_counter(name, description, value):
+    """Returns a counter in the Prometheus text exposition format."""
+    return [f"# HELP {name} {description}", f"# TYPE {name} counter", f"{name} {value}"]
+
+
+def render_metrics(extra=()):
+    """Returns all histograms, followed by any `extra` lines, in the
+    Prometheus text exposition format."""
+    return '\n'.join([line for histogram in HISTOGRAMS for line in histogram.render()] + list(extra)) + '\n'
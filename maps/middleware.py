@@ -0,0 +1,207 @@
+import cProfile
+import json
+import logging
+import random
+from contextlib import ExitStack
+from time import perf_counter
+
+from asgiref.sync import (async_to_sync, iscoroutinefunction,
+                          markcoroutinefunction, sync_to_async)
+from django.db import connections
+
+from cartographer_backend import settings
+
+from .metrics import collect, get_request_metrics, observe_request
+from .profiling import QueryRecorder, save_profile
+from .routers import get_replica_state, read_from_replicas
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsMiddleware:
+    """Records the database, ArchivesSpace and serialization work done for each
+    request.
+
+    Totals are returned in a `Server-Timing` header, logged as JSON at DEBUG
+    level and added to the histograms served by MetricsView. Work done while streaming a
+    response body is not included.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        start = perf_counter()
+        with collect() as metrics:
+            response = self.get_response(request)
+        return self.process_metrics(request, response, metrics, perf_counter() - start)
+
+    async def __acall__(self, request):
+        start = perf_counter()
+        with collect() as metrics:
+            response = await self.get_response(request)
+        return self.process_metrics(request, response, metrics, perf_counter() - start)
+
+    def process_metrics(self, request, response, metrics, duration):
+        match = request.resolver_match
+        labels = {'view': match.view_name if match else 'unmatched', 'method': request.method}
+        observe_request(metrics, duration, **labels)
+        timings = {
+            'db': (metrics.durations['db'], f"{metrics.counts['db']} queries"),
+            'archivesspace': (metrics.durations['archivesspace'], f"{metrics.counts['archivesspace']} requests"),
+            'serialize': (metrics.durations['serialize'], None),
+            'render': (metrics.durations['render'], None),
+            'total': (duration, None),
+        }
+        response['Server-Timing'] = ', '.join(
+            f'{name};dur={seconds * 1000:.1f}' + (f';desc="{description}"' if description else '')
+            for name, (seconds, description) in timings.items())
+        logger.debug(json.dumps({
+            **labels,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 1),
+            'db_queries': metrics.counts['db'],
+            'db_ms': round(metrics.durations['db'] * 1000, 1),
+            'archivesspace_requests': metrics.counts['archivesspace'],
+            'archivesspace_ms': round(metrics.durations['archivesspace'] * 1000, 1),
+            'serialize_ms': round(metrics.durations['serialize'] * 1000, 1),
+            'render_ms': round(metrics.durations['render'] * 1000, 1),
+        }))
+        return response
+
+    def process_template_response(self, request, response):
+        """Times rendering of the response, which happens after this hook."""
+        metrics = get_request_metrics()
+        start = perf_counter()
+
+        def record_render(response):
+            metrics.durations['render'] += perf_counter() - start
+            metrics.counts['render'] += 1
+        response.add_post_render_callback(record_render)
+        return response
+
+
+class ReplicaMiddleware:
+    """Sends the reads of safe requests to read replicas, unless the client
+    has written recently.
+
+    Views which only read can list other methods in `replica_safe_methods`,
+    so that, for example, searches submitted as a POST also use replicas.
+    Responses to requests which wrote set a cookie which keeps the client's
+    requests on the default database for REPLICA_PIN_SECONDS, so that editors
+    see their own changes.
+    """
+    sync_capable = True
+    async_capable = True
+    safe_methods = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with read_from_replicas(self.allow_replicas(request)) as state:
+            response = self.get_response(request)
+        return self.pin(request, response, state)
+
+    async def __acall__(self, request):
+        with read_from_replicas(self.allow_replicas(request)) as state:
+            response = await self.get_response(request)
+        return self.pin(request, response, state)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'cls', getattr(view_func, 'view_class', None))
+        state = get_replica_state()
+        if state and request.method in getattr(view_class, 'replica_safe_methods', ()):
+            state.allowed = settings.REPLICA_PIN_COOKIE not in request.COOKIES
+
+    def allow_replicas(self, request):
+        return request.method in self.safe_methods and settings.REPLICA_PIN_COOKIE not in request.COOKIES
+
+    def pin(self, request, response, state):
+        if settings.DATABASE_REPLICAS and state.wrote:
+            response.set_cookie(
+                settings.REPLICA_PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS, httponly=True,
+                samesite=settings.REPLICA_PIN_COOKIE_SAMESITE, secure=settings.REPLICA_PIN_COOKIE_SECURE)
+        return response
+
+
+class ProfilingMiddleware:
+    """Runs requests under cProfile, storing the profile and the SQL statements
+    executed.
+
+    Requests are profiled when a staff user adds the PROFILE_QUERY_PARAM
+    parameter, or at random at the rate set by PROFILE_SAMPLE_RATE. The name
+    of the stored profile is returned in an `X-Profile` header; profiles are
+    listed in the admin at /admin/profiles/.
+
+    When served with ASGI, a profiled request is handled from a worker thread,
+    in which synchronous views also run, so that they are profiled. Time spent
+    awaiting on the event loop is not broken down.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.should_profile(request):
+            return self.get_response(request)
+        return self.profile(request, self.get_response)
+
+    async def __acall__(self, request):
+        if settings.PROFILE_QUERY_PARAM in request.GET:
+            # Checking the user may query the database
+            profile = await sync_to_async(self.should_profile)(request)
+        else:
+            profile = self.should_profile(request)
+        if not profile:
+            return await self.get_response(request)
+        return await sync_to_async(self.profile)(request, async_to_sync(self.get_response))
+
+    def profile(self, request, get_response):
+        profiler = cProfile.Profile()
+        recorder = QueryRecorder(settings.PROFILE_MAX_QUERIES)
+        try:
+            profiler.enable()
+        except ValueError:
+            # Only one profiler can run at a time in a process
+            return get_response(request)
+        start = perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(recorder))
+                response = get_response(request)
+        finally:
+            profiler.disable()
+        match = request.resolver_match
+        response['X-Profile'] = save_profile(
+            profiler, recorder.queries, method=request.method, path=request.get_full_path(),
+            view=match.view_name if match else None, status=response.status_code,
+            user=request.user.get_username() if request.user.is_authenticated else None,
+            duration_ms=round((perf_counter() - start) * 1000, 3))
+        return response
+
+    def should_profile(self, request):
+        if settings.PROFILE_QUERY_PARAM in request.GET:
+            return request.user.is_staff
+        return random.random() < settings.PROFILE_SAMPLE_RATE
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.16 on 2026-10-18 13:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maps', '0006_arrangementmapcomponent_child_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArrangementMapSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.BinaryField()),
+                ('compressed', models.BooleanField(default=False)),
+                ('map_modified', models.DateTimeField()),
+                ('map', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='snapshot', to='maps.arrangementmap')),
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.16 on 2026-10-18 13:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maps', '0008_job'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='arrangementmap',
+            index=models.Index(fields=['modified'], name='map_modified_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='arrangementmap',
+            index=models.Index(fields=['publish', 'modified'], name='map_publish_modified_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='arrangementmapcomponent',
+            index=models.Index(fields=['modified'], name='component_modified_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='arrangementmapcomponent',
+            index=models.Index(fields=['map', 'tree_index'], name='component_map_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='arrangementmapcomponent',
+            index=models.Index(fields=['archivesspace_uri'], name='component_uri_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deletedarrangementmap',
+            index=models.Index(fields=['deleted'], name='deleted_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.16 on 2026-10-18 13:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maps', '0009_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='arrangementmap',
+            name='map_modified_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='arrangementmapcomponent',
+            name='component_modified_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='deletedarrangementmap',
+            name='deleted_idx',
+        ),
+        migrations.AddIndex(
+            model_name='arrangementmap',
+            index=models.Index(fields=['modified', 'id'], name='map_modified_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='arrangementmapcomponent',
+            index=models.Index(fields=['modified', 'id'], name='component_modified_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deletedarrangementmap',
+            index=models.Index(fields=['deleted', 'id'], name='deleted_idx'),
+        ),
+    ]
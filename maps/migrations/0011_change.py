@@ -0,0 +1,23 @@
+# Generated by Django 4.2.16 on 2026-10-18 13:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maps', '0010_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('sequence', models.BigAutoField(primary_key=True, serialize=False)),
+                ('action', models.CharField(choices=[('create', 'Create'), ('update', 'Update'), ('delete', 'Delete')], max_length=10)),
+                ('ref', models.CharField(max_length=100)),
+                ('archivesspace_uri', models.CharField(blank=True, max_length=255, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.16 on 2026-10-18 13:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maps', '0011_change'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='arrangementmapcomponent',
+            index=models.Index(fields=['map', 'level'], name='component_map_level_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='arrangementmapcomponent',
+            index=models.Index(fields=['tree_id', 'lft'], name='component_tree_idx'),
+        ),
+    ]
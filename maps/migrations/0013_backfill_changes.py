@@ -0,0 +1,35 @@
+from django.db import migrations
+from django.urls import reverse
+
+
+def backfill_changes(apps, schema_editor):
+    """Logs a create for each map and component which has none, such as
+    those which existed before the change log, so that consumers reading the
+    feed from the start see every object."""
+    Change = apps.get_model('maps', 'Change')
+    logged = set(Change.objects.filter(action='create').values_list('ref', flat=True))
+    for model_name, view in [('ArrangementMap', 'arrangementmap-detail'),
+                             ('ArrangementMapComponent', 'arrangementmapcomponent-detail')]:
+        model = apps.get_model('maps', model_name)
+        fields = ['pk', 'archivesspace_uri'] if model_name == 'ArrangementMapComponent' else ['pk']
+        changes = []
+        for values in model.objects.order_by('created', 'pk').values_list(*fields).iterator(chunk_size=1000):
+            ref = reverse(view, kwargs={'pk': values[0]})
+            if ref not in logged:
+                changes.append(Change(
+                    action='create', ref=ref, archivesspace_uri=values[1] if len(values) > 1 else None))
+            if len(changes) == 1000:
+                Change.objects.bulk_create(changes)
+                changes = []
+        Change.objects.bulk_create(changes)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maps', '0012_tree_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_changes, migrations.RunPython.noop),
+    ]
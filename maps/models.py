@@ -1,5 +1,7 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
 from mptt.models import MPTTModel, TreeForeignKey
 
 
@@ -13,6 +15,12 @@ class ArrangementMap(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['modified', 'id'], name='map_modified_idx'),
+            models.Index(fields=['publish', 'modified'], name='map_publish_modified_idx'),
+        ]
+
 
 class ArrangementMapComponent(MPTTModel):
     title = models.CharField(max_length=255, null=True, blank=True)
@@ -25,28 +33,125 @@ class ArrangementMapComponent(MPTTModel):
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['modified', 'id'], name='component_modified_idx'),
+            models.Index(fields=['map', 'tree_index'], name='component_map_order_idx'),
+            models.Index(fields=['archivesspace_uri'], name='component_uri_idx'),
+            models.Index(fields=['map', 'level'], name='component_map_level_idx'),
+            models.Index(fields=['tree_id', 'lft'], name='component_tree_idx'),
+        ]
+
     @property
     def publish(self):
         return self.map.publish
 
     @property
-    def children(self):
-        return ArrangementMapComponent.objects.filter(parent=self)
+    def ancestors(self):
+        """Returns the ancestors of the component, nearest first.
+
+        Uses ancestors loaded by `prefetch_ancestors` if they are available,
+        otherwise fetches them with a single query on the tree fields.
+        """
+        if hasattr(self, '_prefetched_ancestors'):
+            return self._prefetched_ancestors
+        return self.get_ancestors(ascending=True)
+
+
+def prefetch_ancestors(components):
+    """Loads the ancestors of a list of components with a single query.
 
-    def process_ancestors(self, parent, queryset):
-        queryset |= ArrangementMapComponent.objects.filter(pk=parent.pk)
-        if parent.parent:
-            return self.process_ancestors(parent.parent, queryset)
-        return queryset.reverse()
+    Siblings share their ancestors, so only one component per parent is used
+    to select the rows containing it in its tree. Each component's ancestors
+    are then found by following parent ids.
+    """
+    components = [c for c in components if c.parent_id and not hasattr(c, '_prefetched_ancestors')]
+    if not components:
+        return
+    conditions = Q()
+    for component in {c.parent_id: c for c in components}.values():
+        conditions |= Q(tree_id=component.tree_id, lft__lt=component.lft, rght__gt=component.rght)
+    parents = {a.pk: a for a in ArrangementMapComponent.objects.filter(conditions)}
+    for component in components:
+        ancestors = []
+        parent = parents.get(component.parent_id)
+        while parent:
+            ancestors.append(parent)
+            parent = parents.get(parent.parent_id)
+        component._prefetched_ancestors = ancestors
+
+
+class ArrangementMapSnapshot(models.Model):
+    """Stored serialization of an ArrangementMap and its full component tree.
+
+    `map_modified` records the `modified` value of the map the snapshot was
+    built from, so a snapshot is stale whenever the map has been saved since.
+    """
+    map = models.OneToOneField(ArrangementMap, on_delete=models.CASCADE, related_name='snapshot')
+    data = models.BinaryField()
+    compressed = models.BooleanField(default=False)
+    map_modified = models.DateTimeField()
 
     @property
-    def ancestors(self):
-        queryset = ArrangementMapComponent.objects.none()
-        return self.process_ancestors(
-            self.parent, queryset) if self.parent else queryset
+    def is_current(self):
+        return self.map_modified == self.map.modified
 
 
 class DeletedArrangementMap(models.Model):
     ref = models.CharField(max_length=100)
     archivesspace_uri = models.CharField(max_length=255, blank=True, null=True)
     deleted = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['deleted', 'id'], name='deleted_idx')]
+
+
+class Change(models.Model):
+    """An entry in the append-only log of changes to ArrangementMaps and
+    ArrangementMapComponents.
+
+    `sequence` increases monotonically, so consumers of the change feed can
+    resume from the last sequence number they have seen.
+    """
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    ACTION_CHOICES = (
+        (CREATE, 'Create'),
+        (UPDATE, 'Update'),
+        (DELETE, 'Delete'),
+    )
+    sequence = models.BigAutoField(primary_key=True)
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    ref = models.CharField(max_length=100)
+    archivesspace_uri = models.CharField(max_length=255, blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+
+class Job(models.Model):
+    """A unit of background work, run by the `run_jobs` management command."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    )
+
+    task = models.CharField(max_length=100)
+    arguments = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=1)
+    run_after = models.DateTimeField(default=timezone.now)
+    progress = models.JSONField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_after'])]
@@ -0,0 +1,85 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(LimitOffsetPagination):
+    """Limit/offset pagination with an opt-in keyset (cursor) mode.
+
+    If the `cursor` parameter is present (it may be empty for the first page),
+    results are ordered by the view's `keyset_field` and primary key, and each
+    page starts after the last row of the previous one. Unlike offsets, the
+    cost of a page does not grow with its depth, and rows are not skipped or
+    repeated when earlier rows are added or removed. Rows which are modified
+    while a client is paging move to the end of the results.
+    """
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            return super(KeysetPagination, self).paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.field = queryset.model._meta.get_field(getattr(view, 'keyset_field', 'modified'))
+        queryset = queryset.order_by(self.field.name, 'pk')
+        position = self.decode_cursor(request)
+        if position:
+            value, pk = position
+            queryset = queryset.filter(
+                Q(**{f'{self.field.name}__gt': value}) | Q(**{self.field.name: value, 'pk__gt': pk}),
+                **{f'{self.field.name}__gte': value})
+        results = list(queryset[:self.limit + 1])
+        self.has_next = len(results) > self.limit
+        self.page = results[:self.limit]
+        return self.page
+
+    def decode_cursor(self, request):
+        encoded = request.query_params[self.cursor_query_param]
+        if not encoded:
+            return None
+        try:
+            value, pk = json.loads(urlsafe_b64decode(encoded.encode()))
+            return self.field.to_python(value), int(pk)
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, obj):
+        position = [self.field.value_to_string(obj), obj.pk]
+        return urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super(KeysetPagination, self).get_next_link()
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_schema_operation_parameters(self, view):
+        parameters = super(KeysetPagination, self).get_schema_operation_parameters(view)
+        parameters.append({
+            'name': self.cursor_query_param,
+            'required': False,
+            'in': 'query',
+            'description': 'The pagination cursor value. Pass an empty value to start paging by cursor.',
+            'schema': {'type': 'string'},
+        })
+        return parameters
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super(KeysetPagination, self).get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
@@ -0,0 +1,90 @@
+import io
+import json
+import os
+import pstats
+import re
+import uuid
+from time import perf_counter
+
+from django.utils import timezone
+
+from cartographer_backend import settings
+
+NAME_PATTERN = re.compile(r'^[0-9]{20}-[0-9a-f]{8}$')
+
+
+class QueryRecorder:
+    """Database execute wrapper which records statements and their durations."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            if len(self.queries) < self.limit:
+                self.queries.append({'sql': sql, 'duration_ms': round((perf_counter() - start) * 1000, 3)})
+
+
+def save_profile(profiler, queries, **metadata):
+    """Stores a profile and the queries made while it ran, removing the oldest
+    profiles so that no more than PROFILE_MAX_COUNT are kept.
+
+    Each profile is stored as a pstats file and a JSON file of metadata and
+    queries, which share a name. Returns the name.
+    """
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    name = f"{timezone.now():%Y%m%d%H%M%S%f}-{uuid.uuid4().hex[:8]}"
+    profiler.dump_stats(os.path.join(settings.PROFILE_DIR, f"{name}.prof"))
+    metadata.update(
+        name=name, created=timezone.now().isoformat(), query_count=len(queries),
+        query_ms=round(sum(q['duration_ms'] for q in queries), 3))
+    with open(os.path.join(settings.PROFILE_DIR, f"{name}.json"), 'w') as f:
+        json.dump({**metadata, 'queries': queries}, f)
+    for old in list_names()[:-settings.PROFILE_MAX_COUNT]:
+        for extension in ('json', 'prof'):
+            try:
+                os.remove(os.path.join(settings.PROFILE_DIR, f"{old}.{extension}"))
+            except FileNotFoundError:
+                pass
+    return name
+
+
+def list_names():
+    """Returns the names of stored profiles, oldest first."""
+    if not os.path.isdir(settings.PROFILE_DIR):
+        return []
+    return sorted(
+        filename[:-5] for filename in os.listdir(settings.PROFILE_DIR)
+        if filename.endswith('.json') and NAME_PATTERN.match(filename[:-5]))
+
+
+def list_profiles():
+    """Returns the metadata of stored profiles, most costly first."""
+    profiles = []
+    for name in list_names():
+        try:
+            profiles.append(load_profile(name, stats=False))
+        except (FileNotFoundError, ValueError):
+            continue
+    return sorted(profiles, key=lambda p: p['duration_ms'], reverse=True)
+
+
+def load_profile(name, stats=True, limit=50):
+    """Returns the metadata and queries of a stored profile, and optionally
+    the `limit` most costly functions by cumulative time as text."""
+    if not NAME_PATTERN.match(name):
+        raise FileNotFoundError(name)
+    with open(os.path.join(settings.PROFILE_DIR, f"{name}.json")) as f:
+        profile = json.load(f)
+    if stats:
+        output = io.StringIO()
+        pstats.Stats(os.path.join(settings.PROFILE_DIR, f"{name}.prof"), stream=output).sort_stats(
+            'cumulative').print_stats(limit)
+        profile['stats'] = output.getvalue()
+    else:
+        profile.pop('queries', None)
+    return profile
@@ -0,0 +1,10 @@
+from rest_framework.renderers import JSONRenderer
+
+
+class CompactJSONRenderer(JSONRenderer):
+    """JSON renderer for the compact format, requested with `?format=compact`.
+
+    Views which support the format return compact data when this renderer is
+    the accepted renderer.
+    """
+    format = 'compact'
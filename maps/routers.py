@@ -0,0 +1,69 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import DEFAULT_DB_ALIAS
+
+from cartographer_backend import settings
+
+_state = ContextVar('replica_state', default=None)
+
+
+class ReplicaState:
+    """Whether reads may go to a replica while handling a request, the
+    replica chosen for them, and whether the request has written to the
+    default database."""
+
+    def __init__(self, allowed):
+        self.allowed = allowed
+        self.replica = None
+        self.wrote = False
+
+
+def get_replica_state():
+    """Returns the ReplicaState of the current `read_from_replicas` block, if any."""
+    return _state.get()
+
+
+@contextmanager
+def read_from_replicas(allowed=True):
+    """Allows reads within a block to go to read replicas, until the block
+    writes to the default database."""
+    token = _state.set(ReplicaState(allowed))
+    try:
+        yield _state.get()
+    finally:
+        _state.reset(token)
+
+
+class ReplicaRouter:
+    """Sends reads to a randomly chosen replica within `read_from_replicas`,
+    and all other queries to the default database.
+
+    The replica is chosen once per block, so that all the reads made for a
+    request, such as a validator and the body it describes, see the same
+    point in time.
+
+    Once a block has written (or is about to write) to the default database,
+    its reads go there too, so that it always sees its own writes.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state and state.allowed and not state.wrote and settings.DATABASE_REPLICAS:
+            if state.replica not in settings.DATABASE_REPLICAS:
+                state.replica = random.choice(settings.DATABASE_REPLICAS)
+            return state.replica
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
@@ -1,8 +1,15 @@
+from collections import defaultdict
+
+from django.db import models, transaction
+from django.db.models import Max
 from django.urls import reverse
 from rest_framework import serializers
 
-from .models import (ArrangementMap, ArrangementMapComponent,
-                     DeletedArrangementMap)
+from .changes import get_change, record_changes
+from .jobs import schedule_child_count
+from .metrics import TimedDataMixin
+from .models import (ArrangementMap, ArrangementMapComponent, Change,
+                     DeletedArrangementMap, Job, prefetch_ancestors)
 
 
 class ComponentReferenceSerializer(serializers.ModelSerializer):
@@ -18,7 +25,21 @@ class ComponentReferenceSerializer(serializers.ModelSerializer):
         return reverse('arrangementmapcomponent-detail', kwargs={'pk': obj.pk})
 
 
-class ArrangementMapComponentSerializer(serializers.ModelSerializer):
+class TimedListSerializer(TimedDataMixin, serializers.ListSerializer):
+    """ListSerializer which times building the serialized data."""
+
+
+class ArrangementMapComponentPageSerializer(TimedListSerializer):
+    """Loads ancestors for all components in a page with a single query."""
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        iterable = list(iterable)
+        prefetch_ancestors(iterable)
+        return super(ArrangementMapComponentPageSerializer, self).to_representation(iterable)
+
+
+class ArrangementMapComponentSerializer(TimedDataMixin, serializers.ModelSerializer):
     ancestors = ComponentReferenceSerializer(read_only=True, many=True)
     children = ComponentReferenceSerializer(read_only=True, many=True)
     level = serializers.CharField(source='archivesspace_level')
@@ -29,18 +50,161 @@ class ArrangementMapComponentSerializer(serializers.ModelSerializer):
         model = ArrangementMapComponent
         fields = ('id', 'ref', 'title', 'map', 'parent', 'order', 'child_count',
                   'level', 'archivesspace_uri', 'publish', 'ancestors', 'children')
+        list_serializer_class = ArrangementMapComponentPageSerializer
 
     def get_ref(self, obj):
         return reverse('arrangementmapcomponent-detail', kwargs={'pk': obj.pk})
 
 
-class ArrangementMapComponentListSerializer(serializers.ModelSerializer):
+class ArrangementMapComponentListSerializer(TimedDataMixin, serializers.ModelSerializer):
     class Meta:
         model = ArrangementMapComponent
         fields = ('id', 'title')
+        list_serializer_class = TimedListSerializer
+
+
+class ArrangementMapComponentBulkListSerializer(TimedListSerializer):
+    """Creates a batch of ArrangementMapComponents in one transaction.
 
+    Components may refer to existing parents by id (`parent`) or to other
+    components in the batch by key (`parent_key`). Tree fields for new trees
+    are calculated in memory, and only existing trees which receive new
+    components are rebuilt. Components are inserted with one query per level
+    of the batch, so per-component signals do not fire: instead each map is
+    saved once and child counts are scheduled for the whole batch.
+    """
 
-class ArrangementMapSerializer(serializers.ModelSerializer):
+    def validate(self, attrs):
+        keys = [item['key'] for item in attrs if item.get('key')]
+        if len(keys) != len(set(keys)):
+            raise serializers.ValidationError("Component keys must be unique.")
+        items_by_key = {item['key']: item for item in attrs if item.get('key')}
+        maps = ArrangementMap.objects.in_bulk({item['map_id'] for item in attrs})
+        parents = ArrangementMapComponent.objects.in_bulk({item['parent_id'] for item in attrs if item.get('parent_id')})
+        for item in attrs:
+            if item['map_id'] not in maps:
+                raise serializers.ValidationError(f"ArrangementMap {item['map_id']} does not exist.")
+            if item.get('parent_id') and item.get('parent_key'):
+                raise serializers.ValidationError("Components cannot have both `parent` and `parent_key`.")
+            if item.get('parent_id'):
+                parent = parents.get(item['parent_id'])
+                if not parent or parent.map_id != item['map_id']:
+                    raise serializers.ValidationError(f"Parent {item['parent_id']} does not exist in map {item['map_id']}.")
+            if item.get('parent_key'):
+                parent = items_by_key.get(item['parent_key'])
+                if not parent or parent['map_id'] != item['map_id']:
+                    raise serializers.ValidationError(f"Parent key {item['parent_key']} does not exist in map {item['map_id']}.")
+        for item in attrs:
+            seen = set()
+            while item.get('parent_key'):
+                if item['parent_key'] in seen:
+                    raise serializers.ValidationError(f"Parent keys form a cycle at {item['parent_key']}.")
+                seen.add(item['parent_key'])
+                item = items_by_key[item['parent_key']]
+        return attrs
+
+    def place(self, node, left, tree_id, level, depth, children, levels):
+        node.tree_id, node.lft, node.level = tree_id, left, level
+        levels[depth].append(node)
+        right = left + 1
+        for child in children[node.key]:
+            right = self.place(child, right, tree_id, level + 1, depth + 1, children, levels)
+        node.rght = right
+        return right + 1
+
+    @transaction.atomic
+    def create(self, validated_data):
+        maps = ArrangementMap.objects.in_bulk({item['map_id'] for item in validated_data})
+        parents = ArrangementMapComponent.objects.in_bulk(
+            {item['parent_id'] for item in validated_data if item.get('parent_id')})
+        nodes = []
+        children = defaultdict(list)
+        for item in validated_data:
+            node = ArrangementMapComponent(
+                title=item.get('title'), archivesspace_uri=item.get('archivesspace_uri'),
+                archivesspace_level=item.get('archivesspace_level', 'collection'),
+                tree_index=item.get('tree_index'), map=maps[item['map_id']], parent=parents.get(item.get('parent_id')))
+            node.key = item.get('key')
+            nodes.append(node)
+        nodes_by_key = {node.key: node for node in nodes if node.key}
+        for item, node in zip(validated_data, nodes):
+            if item.get('parent_key'):
+                node.parent = nodes_by_key[item['parent_key']]
+                children[item['parent_key']].append(node)
+
+        levels = defaultdict(list)
+        rebuild_tree_ids = set()
+        next_tree_id = (ArrangementMapComponent.objects.aggregate(Max('tree_id'))['tree_id__max'] or 0) + 1
+        for item, node in zip(validated_data, nodes):
+            if item.get('parent_key'):
+                continue
+            if node.parent is None:
+                self.place(node, 1, next_tree_id, 0, 0, children, levels)
+                next_tree_id += 1
+            else:
+                self.place(node, 0, node.parent.tree_id, node.parent.level + 1, 0, children, levels)
+                rebuild_tree_ids.add(node.parent.tree_id)
+        for depth in sorted(levels):
+            ArrangementMapComponent.objects.bulk_create(levels[depth])
+        for tree_id in rebuild_tree_ids:
+            ArrangementMapComponent.objects.partial_rebuild(tree_id)
+
+        record_changes([get_change(Change.CREATE, node) for node in nodes])
+        for map in maps.values():
+            map.save()
+        for node in nodes:
+            if node.archivesspace_uri:
+                schedule_child_count(node.pk)
+        return nodes
+
+
+class ArrangementMapComponentBulkSerializer(TimedDataMixin, serializers.ModelSerializer):
+    key = serializers.CharField(required=False)
+    parent_key = serializers.CharField(required=False, write_only=True)
+    map = serializers.IntegerField(source='map_id')
+    parent = serializers.IntegerField(source='parent_id', required=False, allow_null=True)
+    level = serializers.CharField(source='archivesspace_level', required=False)
+    order = serializers.IntegerField(source='tree_index', required=False, allow_null=True)
+    ref = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ArrangementMapComponent
+        fields = ('id', 'ref', 'key', 'parent_key', 'title', 'map', 'parent', 'order', 'level', 'archivesspace_uri')
+        list_serializer_class = ArrangementMapComponentBulkListSerializer
+
+    def get_ref(self, obj):
+        return reverse('arrangementmapcomponent-detail', kwargs={'pk': obj.pk})
+
+
+class ComponentTreeMixin:
+    """Builds nested trees of ArrangementMapComponents."""
+
+    def process_tree_item(self, item, children_by_parent):
+        node = {'id': item.pk, 'title': item.title, 'ref': self.get_ref(item), 'level': item.archivesspace_level,
+                'parent': item.parent_id, 'archivesspace_uri': item.archivesspace_uri,
+                'order': item.tree_index}
+        children = children_by_parent.get(item.pk)
+        if children:
+            node['children'] = [self.process_tree_item(child, children_by_parent) for child in children]
+        elif item.rght - item.lft > 1:
+            node['has_children'] = True
+            node['descendant_count'] = (item.rght - item.lft - 1) // 2
+        return node
+
+    def group_by_parent(self, components):
+        children_by_parent = defaultdict(list)
+        for component in components:
+            children_by_parent[component.parent_id].append(component)
+        return children_by_parent
+
+
+class ArrangementMapSerializer(ComponentTreeMixin, TimedDataMixin, serializers.ModelSerializer):
+    """Serializes an ArrangementMap with its nested component tree.
+
+    If `depth` is given in the context, only that many levels of the tree are
+    included, and components whose children are left out are marked with
+    `has_children` and the number of their descendants.
+    """
     children = serializers.SerializerMethodField()
     ref = serializers.SerializerMethodField()
 
@@ -48,26 +212,18 @@ class ArrangementMapSerializer(serializers.ModelSerializer):
         model = ArrangementMap
         fields = ('id', 'ref', 'title', 'children', 'publish', 'created', 'modified')
 
-    def process_tree_item(self, objects, tree):
-        for item in objects:
-            parent = item.parent.id if item.parent else None
-            ref = self.get_ref(item)
-            if item.is_leaf_node():
-                tree.append({'id': item.pk, 'title': item.title, 'ref': ref, 'level': item.archivesspace_level,
-                             'parent': parent, 'archivesspace_uri': item.archivesspace_uri,
-                             'order': item.tree_index})
-            else:
-                tree.append({'id': item.pk, 'title': item.title, 'ref': ref, 'level': item.archivesspace_level,
-                             'parent': parent, 'archivesspace_uri': item.archivesspace_uri,
-                             'order': item.tree_index, 'children': []})
-                self.process_tree_item(item.children.all().order_by('tree_index'), tree[-1].get('children'))
-        return tree
-
     def get_children(self, obj):
-        if len(obj.components.all()):
-            self.tree = []
-            self.process_tree_item(obj.components.filter(parent__isnull=True).all().order_by('tree_index'), self.tree)
-            return self.tree
+        """Builds the nested component tree from a single ordered query.
+
+        Components are grouped by parent in memory, so the number of queries
+        does not depend on the size or depth of the tree.
+        """
+        components = obj.components.all()
+        if self.context.get('depth'):
+            components = components.filter(level__lt=self.context['depth'])
+        children_by_parent = self.group_by_parent(components.order_by('tree_index'))
+        if children_by_parent:
+            return [self.process_tree_item(item, children_by_parent) for item in children_by_parent[None]]
 
     def get_ref(self, obj):
         if isinstance(obj, ArrangementMapComponent):
@@ -76,19 +232,96 @@ class ArrangementMapSerializer(serializers.ModelSerializer):
             return reverse('arrangementmap-detail', kwargs={'pk': obj.pk})
 
 
-class ArrangementMapListSerializer(serializers.ModelSerializer):
+class ArrangementMapCompactSerializer(TimedDataMixin, serializers.ModelSerializer):
+    """Serializes an ArrangementMap with its components as parallel arrays,
+    in the same order as a pre-order walk of the nested tree.
+
+    Each component is a position in the arrays, and `parent_index` is the
+    position of its parent (null for top-level components). Components are
+    read as rows of values rather than model instances and their keys are not
+    repeated, so the tree is much cheaper to build and to parse than the
+    nested form.
+    """
+    components = serializers.SerializerMethodField()
+    ref = serializers.SerializerMethodField()
+    columns = ('id', 'parent_index', 'title', 'level', 'archivesspace_uri', 'order', 'child_count')
+
+    class Meta:
+        model = ArrangementMap
+        fields = ('id', 'ref', 'title', 'components', 'publish', 'created', 'modified')
+
+    def get_components(self, obj):
+        children_by_parent = defaultdict(list)
+        for row in obj.components.order_by('tree_index').values_list(
+                'pk', 'parent_id', 'title', 'archivesspace_level', 'archivesspace_uri', 'tree_index', 'child_count'):
+            children_by_parent[row[1]].append(row)
+        rows = []
+        stack = [(row, None) for row in reversed(children_by_parent[None])]
+        while stack:
+            (pk, _, *values), parent_index = stack.pop()
+            stack.extend((child, len(rows)) for child in reversed(children_by_parent.get(pk, ())))
+            rows.append((pk, parent_index, *values))
+        return {name: list(column) for name, column in zip(self.columns, zip(*rows))} or {
+            name: [] for name in self.columns}
+
+    def get_ref(self, obj):
+        return reverse('arrangementmap-detail', kwargs={'pk': obj.pk})
+
+
+class ArrangementMapComponentTreeSerializer(ComponentTreeMixin, TimedDataMixin, serializers.BaseSerializer):
+    """Serializes an ArrangementMapComponent with its descendants nested
+    within it, up to `depth` levels below it (given in the context).
+
+    Descendants are fetched with a single range query on the tree fields, so
+    the cost depends on the number of components returned rather than the
+    size of the map.
+    """
+
+    def to_representation(self, obj):
+        descendants = ArrangementMapComponent.objects.filter(
+            tree_id=obj.tree_id, lft__gt=obj.lft, rght__lt=obj.rght,
+            level__lte=obj.level + self.context['depth']).order_by('tree_index')
+        return self.process_tree_item(obj, self.group_by_parent(descendants))
+
+    def get_ref(self, obj):
+        return reverse('arrangementmapcomponent-detail', kwargs={'pk': obj.pk})
+
+
+class ArrangementMapListSerializer(TimedDataMixin, serializers.ModelSerializer):
     ref = serializers.SerializerMethodField()
 
     class Meta:
         model = ArrangementMap
         fields = ('id', 'ref', 'title', 'publish')
+        list_serializer_class = TimedListSerializer
 
     def get_ref(self, obj):
         return reverse('arrangementmap-detail', kwargs={'pk': obj.pk})
 
 
-class DeletedArrangementMapSerializer(serializers.ModelSerializer):
+class DeletedArrangementMapSerializer(TimedDataMixin, serializers.ModelSerializer):
 
     class Meta:
         model = DeletedArrangementMap
         fields = ('ref', 'archivesspace_uri', 'deleted')
+        list_serializer_class = TimedListSerializer
+
+
+class ChangeSerializer(TimedDataMixin, serializers.ModelSerializer):
+
+    class Meta:
+        model = Change
+        fields = ('sequence', 'action', 'ref', 'archivesspace_uri', 'created')
+        list_serializer_class = TimedListSerializer
+
+
+class JobSerializer(TimedDataMixin, serializers.ModelSerializer):
+    ref = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Job
+        fields = ('id', 'ref', 'task', 'arguments', 'status', 'attempts', 'max_attempts',
+                  'run_after', 'progress', 'result', 'error', 'created', 'modified')
+
+    def get_ref(self, obj):
+        return reverse('job-detail', kwargs={'pk': obj.pk})
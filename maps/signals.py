@@ -1,39 +1,133 @@
-from asnake.aspace import ASpace
-from django.db.models.signals import post_save, pre_delete, pre_save
+import threading
+from contextlib import contextmanager
+
+from django.db.backends.signals import connection_created
+from django.db.models import DEFERRED
+from django.db.models.signals import post_init, post_save, pre_delete
 from django.dispatch import receiver
 from django.urls import reverse
 
-from cartographer_backend import settings
-
-from .models import (ArrangementMap, ArrangementMapComponent,
+from .changes import get_change, record_changes
+from .jobs import schedule_child_count
+from .metrics import record_query
+from .models import (ArrangementMap, ArrangementMapComponent, Change,
                      DeletedArrangementMap)
+from .snapshots import schedule_snapshot_refresh
+
+_batch = threading.local()
+
+
+@contextmanager
+def batch_component_signals():
+    """Defers the writes made by component signals until the end of a block.
+
+    Within the block, tombstones for deleted maps and components are collected
+    and created with a single insert, and each affected ArrangementMap which
+    still exists is saved once rather than once per component. Other maps to
+    be saved at the end of the block can be added to the `map_ids` of the
+    yielded batch. Changes are logged with a single insert, at most once per
+    object.
+    """
+    if getattr(_batch, 'active', False):
+        yield _batch
+        return
+    _batch.active, _batch.tombstones, _batch.map_ids, _batch.changes = True, [], set(), {}
+    try:
+        yield _batch
+        DeletedArrangementMap.objects.bulk_create(_batch.tombstones)
+        for map in ArrangementMap.objects.filter(pk__in=_batch.map_ids):
+            map.save()
+        record_changes(list(_batch.changes.values()))
+    finally:
+        _batch.active, _batch.tombstones, _batch.map_ids, _batch.changes = False, [], set(), {}
+
+
+def log_change(action, instance):
+    """Records a Change to an instance, or adds it to the current batch.
+
+    Within a batch, a create or delete is not replaced by a later update.
+    """
+    change = get_change(action, instance)
+    if not getattr(_batch, 'active', False):
+        record_changes([change])
+    elif change.ref not in _batch.changes or action == Change.DELETE:
+        _batch.changes[change.ref] = change
+
+
+@receiver(post_save, sender=ArrangementMap)
+@receiver(post_save, sender=ArrangementMapComponent)
+def log_saved_change(sender, instance, created, **kwargs):
+    if not kwargs["raw"]:
+        log_change(Change.CREATE if created else Change.UPDATE, instance)
+
+
+@receiver(pre_delete, sender=ArrangementMap)
+@receiver(pre_delete, sender=ArrangementMapComponent)
+def log_deleted_change(sender, instance, **kwargs):
+    log_change(Change.DELETE, instance)
 
 
 @receiver(pre_delete, sender=ArrangementMap)
 def create_deleted_map(sender, instance, **kwargs):
-    DeletedArrangementMap.objects.create(
+    tombstone = DeletedArrangementMap(
         ref=reverse('arrangementmap-detail', kwargs={'pk': instance.pk}))
+    if getattr(_batch, 'active', False):
+        _batch.tombstones.append(tombstone)
+    else:
+        tombstone.save()
 
 
 @receiver(pre_delete, sender=ArrangementMapComponent)
 def create_deleted_component(sender, instance, **kwargs):
-    DeletedArrangementMap.objects.create(
+    tombstone = DeletedArrangementMap(
         ref=reverse('arrangementmapcomponent-detail', kwargs={'pk': instance.pk}),
         archivesspace_uri=instance.archivesspace_uri)
+    if getattr(_batch, 'active', False):
+        _batch.tombstones.append(tombstone)
+    else:
+        tombstone.save()
 
 
 @receiver([post_save, pre_delete], sender=ArrangementMapComponent)
 def update_map(sender, instance, **kwargs):
-    ArrangementMap.objects.get(components=instance).save()
-
-
-@receiver(pre_save, sender=ArrangementMapComponent)
-def calculate_child_count(sender, instance, **kwargs):
-    if instance.archivesspace_uri and not kwargs["raw"]:
-        aspace = ASpace(baseurl=settings.ASPACE['baseurl'],
-                        username=settings.ASPACE['username'],
-                        password=settings.ASPACE['password'])
-        escaped_uri = instance.archivesspace_uri.replace('/', r'\/')
-        search_uri = f"search?q=resource:/{escaped_uri}/ AND publish:true&page=1&fields[]=uri&type[]=archival_object&page_size=1"
-        resource = aspace.client.get(search_uri).json()
-        instance.child_count = resource["total_hits"]
+    if getattr(_batch, 'active', False):
+        _batch.map_ids.add(instance.map_id)
+    else:
+        ArrangementMap.objects.get(components=instance).save()
+
+
+@receiver(post_save, sender=ArrangementMap)
+def update_snapshot(sender, instance, **kwargs):
+    if not kwargs["raw"]:
+        schedule_snapshot_refresh(instance.pk)
+
+
+@receiver(post_init, sender=ArrangementMapComponent)
+def track_archivesspace_uri(sender, instance, **kwargs):
+    instance._loaded_archivesspace_uri = instance.__dict__.get('archivesspace_uri', DEFERRED)
+
+
+@receiver(post_save, sender=ArrangementMapComponent)
+def calculate_child_count(sender, instance, created, **kwargs):
+    """Schedules a child count update if the component's URI has changed.
+
+    Updates are batched and run once the current transaction commits.
+    """
+    loaded_uri = instance._loaded_archivesspace_uri
+    instance._loaded_archivesspace_uri = instance.__dict__.get('archivesspace_uri', DEFERRED)
+    if kwargs["raw"] or not instance.archivesspace_uri:
+        return
+    if created or (loaded_uri is not DEFERRED and loaded_uri != instance.archivesspace_uri):
+        schedule_child_count(instance.pk)
+
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    """Times the queries made on each new database connection, for the
+    metrics of the request which makes them.
+
+    The wrapper is inserted first so that wrappers added for the length of a
+    block, which are removed from the end of the list, are unaffected.
+    """
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_query)
@@ -0,0 +1,120 @@
+import json
+import zlib
+
+from asgiref.sync import sync_to_async
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.renderers import JSONRenderer
+
+from cartographer_backend import settings
+
+from .jobs import enqueue, task
+from .models import ArrangementMap, ArrangementMapSnapshot, Job
+from .serializers import ArrangementMapSerializer
+
+
+def render_map(map):
+    """Returns the serialized JSON for an ArrangementMap."""
+    return JSONRenderer().render(ArrangementMapSerializer(map).data)
+
+
+def build_snapshot(map):
+    """Serializes an ArrangementMap and stores the result as its snapshot."""
+    data = render_map(map)
+    compressed = settings.COMPRESS_MAP_SNAPSHOTS
+    if compressed:
+        data = zlib.compress(data)
+    snapshot, _ = ArrangementMapSnapshot.objects.update_or_create(
+        map=map, defaults={'data': data, 'compressed': compressed, 'map_modified': map.modified})
+    return snapshot
+
+
+def refresh_snapshot(map_pk):
+    """Rebuilds the snapshot for an ArrangementMap if it is missing or stale.
+
+    A refresh which was scheduled by an earlier write does no work if a later
+    read or refresh has already rebuilt the snapshot.
+    """
+    try:
+        map = ArrangementMap.objects.select_related('snapshot').get(pk=map_pk)
+    except ArrangementMap.DoesNotExist:
+        return
+    if not (hasattr(map, 'snapshot') and map.snapshot.is_current):
+        build_snapshot(map)
+
+
+@task
+def refresh_map_snapshot(job, map_id):
+    """Rebuilds the snapshot of an ArrangementMap which has been saved."""
+    refresh_snapshot(map_id)
+
+
+def schedule_snapshot_refresh(map_pk):
+    """Enqueues a refresh of an ArrangementMap's snapshot, unless one is
+    already waiting to run.
+
+    Snapshots are rebuilt in the background rather than in the request which
+    saved the map, so that a write to one component does not serialize the
+    whole tree. Until the Job runs, the detail view sees that the snapshot
+    is stale.
+    """
+    if not Job.objects.filter(task='refresh_map_snapshot', status=Job.PENDING, arguments={'map_id': map_pk}).exists():
+        enqueue('refresh_map_snapshot', map_id=map_pk)
+
+
+def get_snapshot_json(map):
+    """Returns the rendered JSON for an ArrangementMap from its snapshot,
+    rebuilding the snapshot first if it is missing or stale.
+
+    A map read from a replica may lag behind the default database, so its
+    snapshot is never rebuilt from it, which could overwrite a newer one.
+    The map is serialized instead, and the snapshot is left to be refreshed
+    by the Job enqueued by the write which made it stale, or by
+    `warm_map_snapshots`.
+    """
+    try:
+        snapshot = map.snapshot
+        current = snapshot.is_current
+    except ArrangementMapSnapshot.DoesNotExist:
+        current = False
+    if not current:
+        if map._state.db != DEFAULT_DB_ALIAS:
+            return render_map(map)
+        snapshot = build_snapshot(map)
+    data = bytes(snapshot.data)
+    if snapshot.compressed:
+        data = zlib.decompress(data)
+    return data
+
+
+def get_snapshot_data(map):
+    """Returns the serialized data for an ArrangementMap from its snapshot."""
+    return json.loads(get_snapshot_json(map))
+
+
+def export_maps(modified_since=None):
+    """Yields the snapshot of each published ArrangementMap as a line of JSON.
+
+    Maps are read in chunks, ordered by modification time, so memory use does
+    not grow with the number of maps exported.
+    """
+    maps = ArrangementMap.objects.filter(publish=True)
+    if modified_since:
+        maps = maps.filter(modified__gte=modified_since)
+    for map in maps.select_related('snapshot').order_by('modified', 'pk').iterator(chunk_size=100):
+        yield get_snapshot_json(map) + b"\n"
+
+
+async def aexport_maps(modified_since=None):
+    """Asynchronous version of export_maps, for streaming responses under ASGI.
+
+    Each line is produced by export_maps in the thread used for synchronous
+    code, so the database cursor stays on one connection while lines are
+    sent without holding up the event loop.
+    """
+    lines = export_maps(modified_since)
+    next_line = sync_to_async(next)
+    try:
+        while (line := await next_line(lines, None)) is not None:
+            yield line
+    finally:
+        await sync_to_async(lines.close)()
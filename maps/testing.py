@@ -0,0 +1,134 @@
+import json
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class ArchivesSpaceStub:
+    """A minimal local ArchivesSpace API for tests and benchmarks.
+
+    Serves login, version, search and record routes from an in-memory dict of
+    records keyed by URI, waiting `latency` seconds before each response. Use
+    as a context manager; `baseurl` is available once the server has started.
+
+    Every request is recorded in `requests` as a `(method, path)` tuple. The
+    client addresses of connections made are kept in `connections`, and the
+    most requests handled at once in `max_active`.
+    Requests without a session token from a login are rejected with a 412, as
+    are requests with a token which has been expired by `expire_sessions`.
+    """
+
+    def __init__(self, records=None, latency=0, child_count=0):
+        self.records = records or {}
+        self.latency = latency
+        self.child_count = child_count
+        self.requests = []
+        self.connections = set()
+        self.active = self.max_active = 0
+        self.sessions = set()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def baseurl(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def count(self, method, pattern=""):
+        """Returns the number of recorded requests matching a method and path pattern."""
+        return len([r for r in self.requests if r[0] == method and re.search(pattern, r[1])])
+
+    def expire_sessions(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def handle(self, method, path, query, body, token=None):
+        """Records a request and responds to it after `latency` seconds."""
+        with self.lock:
+            self.requests.append((method, path))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.latency)
+            return self.route(method, path, query, body, token)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def route(self, method, path, query, body, token):
+        """Returns a status code and JSON-serializable body for a request."""
+        if re.match(r"^/users/[^/]+/login$", path):
+            with self.lock:
+                token = f"stub-session-{len(self.requests)}"
+                self.sessions.add(token)
+            return 200, {"session": token}
+        if token not in self.sessions:
+            return 412, {"error": {"code": "SESSION_GONE"}}
+        if path == "/version":
+            return 200, "ArchivesSpace (v3.0.0)"
+        if path == "/search":
+            uri = query.get("q", [""])[0].partition('id:"')[2].rstrip('"')
+            if uri in self.records:
+                return 200, {"total_hits": 1, "results": [{"uri": uri, "system_mtime": self.records[uri].get("system_mtime")}]}
+            return 200, {"total_hits": self.child_count, "results": []}
+        if re.match(r"^/repositories/\d+$", path):
+            return 200, {"uri": path, "jsonmodel_type": "repository"}
+        if re.match(r"^/repositories/\d+/resources$", path) and "all_ids" in query:
+            return 200, [int(uri.split("/")[-1]) for uri in self.records if uri.startswith(f"{path}/")]
+        if path not in self.records:
+            return 404, {"error": "Record not found"}
+        if method == "POST":
+            with self.lock:
+                self.records[path] = dict(
+                    body, lock_version=self.records[path].get("lock_version", 0) + 1,
+                    system_mtime=datetime.now(timezone.utc).isoformat())
+            return 200, {"status": "Updated", "uri": path}
+        return 200, self.records[path]
+
+    def handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def respond(self, method):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                try:
+                    body = json.loads(raw) if raw else None
+                except ValueError:
+                    body = None
+                with stub.lock:
+                    stub.connections.add(self.client_address)
+                status, data = stub.handle(
+                    method, url.path, parse_qs(url.query), body, self.headers.get("X-ArchivesSpace-Session"))
+                content = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.respond("GET")
+
+            def do_POST(self):
+                self.respond("POST")
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
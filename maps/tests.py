@@ -1,19 +1,49 @@
+import asyncio
+import gzip
+import json
+import os
 import random
 import string
+import tempfile
+import time
+from datetime import datetime
+from importlib import import_module
+from io import StringIO
+from unittest.mock import patch
 
 import vcr
-from django.test import TestCase
+from asgiref.sync import async_to_sync
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils.timezone import make_aware
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIRequestFactory
 
 from cartographer_backend import settings
 
+from .archivesspace import (ArchivesSpaceClient, get_async_client, get_client,
+                            propagate_publish, resource_cache_stats)
+from .benchmarks import build_map
+from .jobs import claim_job, enqueue, run_job, schedule_child_count
+from .middleware import ReplicaMiddleware
 from .models import (ArrangementMap, ArrangementMapComponent,
-                     DeletedArrangementMap)
+                     ArrangementMapSnapshot, Change, DeletedArrangementMap,
+                     Job)
+from .routers import ReplicaRouter, read_from_replicas
 from .serializers import (ArrangementMapComponentSerializer,
                           ArrangementMapSerializer)
+from .snapshots import get_snapshot_json
+from .testing import ArchivesSpaceStub
 from .views import (ArrangementMapComponentViewset, ArrangementMapViewset,
-                    FindByURIView)
+                    AsyncResourceFetcherView, FindByURIBatchView,
+                    FindByURIView, JobViewset)
 
 edit_vcr = vcr.VCR(
     serializer='json',
@@ -39,6 +69,8 @@ class CartographerTest(TestCase):
     def setUp(self):
         self.component_number = 10
         self.factory = APIRequestFactory()
+        cache.clear()
+        caches[settings.RESOURCE_CACHE].clear()
 
     def test_create_maps(self):
         """Test creation of ArrangementMap objects."""
@@ -74,6 +106,99 @@ class CartographerTest(TestCase):
                 self.component_number,
                 f"Expecting {self.component_number} ArrangementMapComponent objects but got {len(ArrangementMapComponent.objects.all())}")
 
+    def test_bulk_create_components(self):
+        """Tests bulk creation of ArrangementMapComponent objects."""
+        map = ArrangementMap.objects.get(pk=1)
+        root = ArrangementMapComponent.objects.filter(map=map, parent__isnull=True).first()
+        uris = ["/repositories/2/resources/1", "/repositories/2/resources/2"]
+        data = [
+            {"key": "a", "title": get_title_string(), "map": map.pk, "order": 10, "archivesspace_uri": uris[0]},
+            {"key": "b", "parent_key": "a", "title": get_title_string(), "map": map.pk, "order": 0, "archivesspace_uri": uris[0]},
+            {"key": "c", "parent_key": "b", "title": get_title_string(), "map": map.pk, "order": 0, "archivesspace_uri": uris[1]},
+            {"key": "d", "parent_key": "a", "title": get_title_string(), "map": map.pk, "order": 1},
+            {"key": "e", "parent": root.pk, "title": get_title_string(), "map": map.pk, "order": 5, "archivesspace_uri": uris[1]},
+            {"parent_key": "e", "title": get_title_string(), "map": map.pk, "order": 0, "level": "series"},
+        ]
+        modified = map.modified
+        view = ArrangementMapComponentViewset.as_view(actions={"post": "bulk"})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = view(self.factory.post(reverse("arrangementmapcomponent-bulk"), format="json", data=data))
+        self.assertEqual(response.status_code, 201, f"Error creating components: {response.data}")
+        self.assertEqual([c["key"] for c in response.data][:5], ["a", "b", "c", "d", "e"])
+        created = {c["key"]: ArrangementMapComponent.objects.get(pk=c["id"]) for c in response.data}
+        self.assertEqual(created["c"].parent.parent, created["a"], "Parent keys were not resolved")
+        self.assertEqual(created["e"].parent, root, "Existing parent was not used")
+        map.refresh_from_db()
+        self.assertTrue(map.modified > modified, "Map was not updated")
+
+        self.assert_tree_fields_valid()
+
+        job = Job.objects.get(task="update_child_counts")
+        with ArchivesSpaceStub(child_count=7) as stub:
+            with patch.dict(settings.ASPACE, {"baseurl": stub.baseurl}):
+                call_command("run_jobs", "--burst", stdout=open(os.devnull, "w"))
+        self.assertEqual(job.arguments["component_ids"], sorted(c.pk for c in created.values() if c.archivesspace_uri))
+        self.assertEqual(stub.count("GET", "search"), len(uris), "Child counts were not looked up once per URI")
+
+        cycle = [{"key": "x", "parent_key": "y", "map": map.pk}, {"key": "y", "parent_key": "x", "map": map.pk}]
+        response = view(self.factory.post(reverse("arrangementmapcomponent-bulk"), format="json", data=cycle))
+        self.assertEqual(response.status_code, 400, "Cyclical parent keys were accepted")
+
+    def test_replace_tree(self):
+        """Tests replacing a map's tree, writing only changed components."""
+        map = ArrangementMap.objects.get(pk=1)
+        view = ArrangementMapViewset.as_view(actions={"put": "tree"})
+        url = reverse("arrangementmap-tree", kwargs={"pk": map.pk})
+
+        def replace(tree):
+            with CaptureQueriesContext(connection) as queries:
+                response = view(self.factory.put(url, format="json", data={"children": tree}), pk=map.pk)
+            self.assertEqual(response.status_code, 200, f"Error replacing tree: {response.data}")
+            return response.data, len(queries)
+
+        tree = ArrangementMapSerializer(map).data["children"]
+        summary, _ = replace(tree)
+        self.assertEqual(summary, {"inserted": [], "moved": [], "updated": [], "deleted": []})
+        tree[0]["title"] = get_title_string()
+        _, small_queries = replace(tree)
+        for i in range(100):
+            ArrangementMapComponent.objects.create(title=get_title_string(), map=map, tree_index=10 + i)
+        tree = ArrangementMapSerializer(map).data["children"]
+        tree[0]["title"] = get_title_string()
+        summary, large_queries = replace(tree)
+        self.assertEqual(summary["updated"], [tree[0]["id"]])
+        self.assertEqual(small_queries, large_queries, "Queries grew with the size of the tree")
+
+        tree = ArrangementMapSerializer(map).data["children"][:3]
+        first, second, third = tree
+        moved = first["children"].pop()
+        second.setdefault("children", []).append(moved)
+        first["children"][0]["children"] = [{"title": "New", "level": "series", "order": 0,
+                                             "children": [{"title": "Newer", "order": 0}]}]
+        third["archivesspace_uri"] = "/repositories/2/resources/3"
+        deleted_count = DeletedArrangementMap.objects.count()
+        with self.captureOnCommitCallbacks(execute=True):
+            summary, _ = replace(tree)
+        self.assertEqual(len(summary["inserted"]), 2)
+        self.assertEqual(summary["moved"], [moved["id"]])
+        self.assertEqual(summary["updated"], [third["id"]])
+        self.assertEqual(len(summary["deleted"]), 100)
+        self.assertEqual(DeletedArrangementMap.objects.count(), deleted_count + 100, "Tombstones were not created")
+        self.assertEqual(ArrangementMapComponent.objects.get(pk=moved["id"]).parent_id, second["id"])
+        self.assertEqual(ArrangementMapComponent.objects.get(title="Newer").parent.parent_id, first["children"][0]["id"])
+        self.assertEqual(Job.objects.get(task="update_child_counts").arguments, {"component_ids": [third["id"]]})
+        self.assertEqual(ArrangementMapComponent.objects.filter(map=map).count(), 7)
+        self.assert_tree_fields_valid()
+
+        response = view(self.factory.put(url, format="json", data={"children": [{"id": 9999}]}), pk=map.pk)
+        self.assertEqual(response.status_code, 400, "Unknown component was accepted")
+        component_id = ArrangementMapComponent.objects.filter(map=map)[0].pk
+        for node in [{"id": component_id, "order": "abc"}, {"id": component_id, "title": "a" * 256},
+                     {"title": "New", "level": None}, {"id": "abc"}]:
+            response = view(self.factory.put(url, format="json", data={"children": [node]}), pk=map.pk)
+            self.assertEqual(response.status_code, 400, f"Invalid node {node} was accepted")
+        self.assertEqual(ArrangementMapComponent.objects.filter(map=map).count(), 7, "Invalid tree was written")
+
     def test_edit_objects(self):
         """Tests editing of ArrangementMap objects."""
         for model, serializer, view, viewset in [
@@ -91,6 +216,147 @@ class CartographerTest(TestCase):
                 self.assertEqual(title, obj.title, "Title was not updated")
                 self.assertTrue(obj.created < obj.modified, "Modified time was not updated")
 
+    def test_map_tree_query_count(self):
+        """Tests that serializing a map tree uses a constant number of queries."""
+        map = ArrangementMap.objects.create(title=get_title_string())
+        components = []
+        for size in [10, 100]:
+            for i in range(len(components), size):
+                components.append(ArrangementMapComponent.objects.create(
+                    title=get_title_string(), map=map, tree_index=i,
+                    parent=random.choice(components) if components else None))
+            with self.assertNumQueries(1):
+                tree = ArrangementMapSerializer(map).data["children"]
+            self.assertEqual(self.count_tree_nodes(tree), size, "Wrong number of components in tree")
+
+    def assert_tree_fields_valid(self):
+        """Checks MPTT fields of all components against their parent links."""
+        components = list(ArrangementMapComponent.objects.all())
+        for component in components:
+            ancestors = []
+            parent = component.parent
+            while parent:
+                ancestors.insert(0, parent.pk)
+                parent = parent.parent
+            self.assertEqual(list(component.get_ancestors().values_list("pk", flat=True)), ancestors)
+            self.assertEqual(component.level, len(ancestors))
+            descendants = [c for c in components if component.pk in [a.pk for a in c.get_ancestors()]]
+            self.assertEqual(component.get_descendant_count(), len(descendants), f"Tree fields of {component} are invalid")
+
+    def count_tree_nodes(self, tree):
+        return sum(1 + self.count_tree_nodes(node.get("children", [])) for node in tree)
+
+    def test_publish_propagation(self):
+        """Tests concurrent propagation of publish status to ArchivesSpace."""
+        latency = 0.1
+        uris = [f"/repositories/2/resources/{i}" for i in range(8)]
+        records = {uri: {"uri": uri, "publish": False} for uri in uris}
+        records[uris[0]]["publish"] = True
+        with ArchivesSpaceStub(records=records, latency=latency) as stub:
+            client = ArchivesSpaceClient(baseurl=stub.baseurl, username="admin", password="admin")
+            client.authorize()
+            start = time.time()
+            results = propagate_publish(client, uris + uris + [None, "/repositories/2/resources/404"], True, max_workers=4)
+            elapsed = time.time() - start
+        self.assertEqual(results[uris[0]]["status"], "unchanged", "Already published record was updated")
+        for uri in uris[1:]:
+            self.assertEqual(results[uri]["status"], "updated", f"Record {uri} was not updated")
+            self.assertTrue(stub.records[uri]["publish"], f"Record {uri} was not published")
+        self.assertEqual(results["/repositories/2/resources/404"]["status"], "error", "Missing record not reported")
+        self.assertEqual(stub.count("GET", "resources"), len(uris) + 1, "Duplicate URIs were not skipped")
+        self.assertEqual(stub.count("POST", "resources"), len(uris) - 1, "Unchanged records were posted")
+        self.assertTrue(elapsed < (2 * len(uris) - 1) * latency, "Records were not updated concurrently")
+
+    def test_archivesspace_client(self):
+        """Tests that the shared ArchivesSpace client reuses logins and connections."""
+        with ArchivesSpaceStub(records={"/repositories/2/resources/1": {"publish": True}}) as stub:
+            with patch.dict(settings.ASPACE, {"baseurl": stub.baseurl}):
+                client = get_client()
+                self.assertIs(client, get_client(), "Client was not reused")
+                for i in range(5):
+                    self.assertEqual(get_client().get("repositories/2/resources/1").status_code, 200)
+                stub.expire_sessions()
+                self.assertEqual(get_client().get("repositories/2/resources/1").status_code, 200, "Expired session was not renewed")
+                stats = client.stats
+        self.assertEqual(stub.count("POST", "login"), 2, "Wrong number of logins")
+        self.assertEqual(stats["logins"], 2)
+        self.assertEqual(stats["connections"], 1, "Connections were not reused")
+        self.assertEqual(stats["reused_connections"], stats["requests"] - 1)
+
+    def test_publish_map(self):
+        """Tests that updating a map only propagates changed publish status,
+        and does so in a background job."""
+        map = random.choice(ArrangementMap.objects.filter(components__isnull=False).distinct())
+        uri = "/repositories/2/resources/1"
+        ArrangementMapComponent.objects.filter(map=map).update(archivesspace_uri=uri)
+        view = ArrangementMapViewset.as_view(actions={"put": "update"})
+        data = ArrangementMapSerializer(map).data
+        request = self.factory.put(reverse("arrangementmap-detail", kwargs={"pk": map.pk}), format="json", data=data)
+        response = view(request, pk=map.pk)
+        self.assertEqual(response.status_code, 200, f"Error updating map: {response.data}")
+        self.assertFalse(Job.objects.filter(task="publish_map").exists(), "Job created when publish was unchanged")
+        data["publish"] = not map.publish
+        request = self.factory.put(reverse("arrangementmap-detail", kwargs={"pk": map.pk}), format="json", data=data)
+        response = view(request, pk=map.pk)
+        self.assertEqual(response.status_code, 202, f"Error publishing map: {response.data}")
+        job = Job.objects.get(task="publish_map")
+        self.assertEqual(response.data["job"], reverse("job-detail", kwargs={"pk": job.pk}))
+
+        with ArchivesSpaceStub(records={uri: {"uri": uri, "publish": map.publish}}) as stub:
+            with patch.dict(settings.ASPACE, {"baseurl": stub.baseurl}):
+                call_command("run_jobs", "--burst", stdout=open(os.devnull, "w"))
+        self.assertEqual(stub.records[uri]["publish"], not map.publish, "Publish status was not propagated")
+        request = self.factory.get(response.data["job"], format="json")
+        job_response = JobViewset.as_view(actions={"get": "retrieve"})(request, pk=job.pk)
+        self.assertEqual(job_response.data["status"], Job.SUCCEEDED, f"Job did not succeed: {job_response.data}")
+        self.assertEqual(job_response.data["result"], {uri: {"status": "updated"}})
+        self.assertEqual(job_response.data["progress"], {"completed": 1, "total": 1})
+
+    def test_job_retries(self):
+        """Tests that failed jobs are retried with backoff until they run out of attempts."""
+        map = random.choice(ArrangementMap.objects.filter(components__isnull=False).distinct())
+        ArrangementMapComponent.objects.filter(map=map).update(archivesspace_uri="/repositories/2/resources/404")
+        # Snapshot refreshes queued while loading fixtures
+        Job.objects.all().delete()
+        job = enqueue("publish_map", map_id=map.pk)
+        with ArchivesSpaceStub() as stub:
+            with patch.dict(settings.ASPACE, {"baseurl": stub.baseurl}):
+                for attempt in range(1, job.max_attempts + 1):
+                    job = run_job(claim_job())
+                    self.assertEqual(job.attempts, attempt)
+                    if attempt < job.max_attempts:
+                        self.assertEqual(job.status, Job.PENDING, "Failed job was not rescheduled")
+                        self.assertIsNone(claim_job(), "Job was retried before backoff elapsed")
+                        Job.objects.filter(pk=job.pk).update(run_after=job.created)
+        self.assertEqual(job.status, Job.FAILED, "Job was not marked as failed")
+        self.assertTrue(job.error, "Job error was not recorded")
+
+    def test_child_count_job(self):
+        """Tests that child counts are updated in one batch when component URIs change."""
+        components = ArrangementMapComponent.objects.all()[:3]
+        with self.captureOnCommitCallbacks(execute=True):
+            for component in components:
+                component.tree_index += 1
+                component.save()
+        self.assertFalse(Job.objects.filter(task="update_child_counts").exists(),
+                         "Child count update queued when URI was unchanged")
+        with self.captureOnCommitCallbacks(execute=True):
+            for component in components:
+                component.archivesspace_uri = "/repositories/2/resources/2"
+                component.save()
+        job = Job.objects.get(task="update_child_counts")
+        self.assertEqual(job.arguments, {"component_ids": sorted(c.pk for c in components)})
+        with ArchivesSpaceStub(child_count=12) as stub:
+            with patch.dict(settings.ASPACE, {"baseurl": stub.baseurl}):
+                call_command("run_jobs", "--burst", stdout=open(os.devnull, "w"))
+                self.assertEqual(stub.count("GET", "search"), 1, "Shared URI was looked up more than once")
+                enqueue("update_child_counts", component_ids=[c.pk for c in components])
+                call_command("run_jobs", "--burst", stdout=open(os.devnull, "w"))
+                self.assertEqual(stub.count("GET", "search"), 1, "Cached child count was looked up again")
+        for component in components:
+            component.refresh_from_db()
+            self.assertEqual(component.child_count, 12, "Child count was not updated")
+
     def test_delete_maps(self):
         """Tests deletion of ArrangementMap objects."""
         delete_number = 1
@@ -105,6 +371,38 @@ class CartographerTest(TestCase):
             delete_number,
             "DeletedArrangementMap objects were not created on delete")
 
+    def test_delete_map_query_count(self):
+        """Tests that deleting a map writes its tombstones in a constant number of queries."""
+        query_counts = []
+        for size in [5, 50]:
+            map = ArrangementMap.objects.create(title=get_title_string())
+            for i in range(size):
+                ArrangementMapComponent.objects.create(title=get_title_string(), map=map, tree_index=i)
+            tombstones = DeletedArrangementMap.objects.count()
+            request = self.factory.delete(reverse("arrangementmap-detail", kwargs={"pk": map.pk}), format="json")
+            with CaptureQueriesContext(connection) as queries:
+                response = ArrangementMapViewset.as_view(actions={"delete": "destroy"})(request, pk=map.pk)
+            self.assertEqual(response.status_code, 204, "Wrong HTTP status code")
+            self.assertEqual(DeletedArrangementMap.objects.count(), tombstones + size + 1, "Tombstones were not created")
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1], "Queries grew with the size of the map")
+
+    def test_compact_tombstones(self):
+        """Tests that superseded and expired tombstones are removed."""
+        ArrangementMapComponent.objects.all().delete()
+        ref = DeletedArrangementMap.objects.first().ref
+        for i in range(3):
+            DeletedArrangementMap.objects.create(ref=ref)
+        expired = random.choice(DeletedArrangementMap.objects.exclude(ref=ref))
+        DeletedArrangementMap.objects.filter(pk=expired.pk).update(
+            deleted=make_aware(datetime.fromtimestamp(time.time() - 400 * 86400)))
+        remaining = DeletedArrangementMap.objects.count() - 4
+
+        call_command("compact_tombstones", stdout=open(os.devnull, "w"))
+        self.assertEqual(DeletedArrangementMap.objects.count(), remaining, "Wrong number of tombstones removed")
+        self.assertEqual(DeletedArrangementMap.objects.filter(ref=ref).count(), 1, "Superseded tombstones were kept")
+        self.assertFalse(DeletedArrangementMap.objects.filter(pk=expired.pk).exists(), "Expired tombstone was kept")
+
     def test_list_views(self):
         """Tests list views for ArrangementMap and ArrangementMapComponent objects."""
         for view, viewset in [('arrangementmap-list', ArrangementMapViewset), ('arrangementmapcomponent-list', ArrangementMapComponentViewset)]:
@@ -118,16 +416,318 @@ class CartographerTest(TestCase):
             response = viewset.as_view(actions={"get": "list"})(request)
             self.assertEqual(response.status_code, 200, f"Request error: {response.data}")
 
+    def test_published_filter(self):
+        """Tests that the `published` parameter excludes unpublished objects."""
+        ArrangementMap.objects.update(publish=False)
+        published = random.choice(ArrangementMap.objects.filter(components__isnull=False).distinct())
+        published.publish = True
+        published.save()
+        for view, viewset, expected in [
+                ('arrangementmap-list', ArrangementMapViewset, ArrangementMap.objects.filter(publish=True)),
+                ('arrangementmapcomponent-list', ArrangementMapComponentViewset, published.components.all())]:
+            request = self.factory.get(f'{reverse(view)}?published&limit=1000', format="json")
+            response = viewset.as_view(actions={"get": "list"})(request)
+            self.assertEqual(response.status_code, 200, f"Request error: {response.data}")
+            self.assertEqual(response.data["count"], expected.count(), "Unpublished objects were returned")
+            self.assertEqual(
+                set(obj["id"] for obj in response.data["results"]),
+                set(expected.values_list("pk", flat=True)))
+
+    def assert_uses_index(self, queryset, *index_names):
+        """Asserts that the query plan for a queryset uses one of the named indexes."""
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            plan = queryset.explain()
+        self.assertTrue(
+            any(index_name in plan for index_name in index_names),
+            f"Query does not use {' or '.join(index_names)}: {plan}")
+
+    def test_filter_indexes(self):
+        """Tests that common filters are backed by indexes."""
+        component = random.choice(ArrangementMapComponent.objects.all())
+        since = make_aware(datetime.fromtimestamp(random.randint(1500000000, 2500000000)))
+        # SQLite compares booleans without an operator, so it can only seek
+        # on the trailing `modified` column of the composite index.
+        for queryset, index_names in [
+                (ArrangementMap.objects.filter(modified__gte=since).order_by("title"), ["map_modified_idx"]),
+                (ArrangementMap.objects.filter(publish=True, modified__gte=since).order_by("title"),
+                    ["map_publish_modified_idx", "map_modified_idx"]),
+                (ArrangementMapComponent.objects.filter(modified__gte=since).order_by("title"), ["component_modified_idx"]),
+                (ArrangementMapComponent.objects.filter(
+                    map=component.map_id, tree_index__lt=component.tree_index), ["component_map_order_idx"]),
+                (ArrangementMapComponent.objects.filter(
+                    archivesspace_uri=component.archivesspace_uri), ["component_uri_idx"]),
+                (DeletedArrangementMap.objects.filter(deleted__gte=since).order_by("-deleted"), ["deleted_idx"])]:
+            self.assert_uses_index(queryset, *index_names)
+
     def test_detail_views(self):
         """Tests detail views for ArrangementMap and ArrangementMapComponent objects."""
-        for model, view, viewset in [
-                (ArrangementMap, 'arrangementmap-detail', ArrangementMapViewset),
-                (ArrangementMapComponent, 'arrangementmapcomponent-detail', ArrangementMapComponentViewset)]:
+        for model, view in [
+                (ArrangementMap, 'arrangementmap-detail'),
+                (ArrangementMapComponent, 'arrangementmapcomponent-detail')]:
             for obj in model.objects.all():
-                request = self.factory.get(reverse(view, kwargs={"pk": obj.pk}), format="json")
-                response = viewset.as_view(actions={"get": "retrieve"})(request, pk=obj.pk)
-                self.assertEqual(response.status_code, 200, f"Error in {model} detail view: {response.data}")
-                self.assertIsNot(response.data.get("id"), None, "`id` key missing from response.")
+                response = self.client.get(reverse(view, kwargs={"pk": obj.pk}))
+                self.assertEqual(response.status_code, 200, f"Error in {model} detail view: {response.content}")
+                self.assertIsNot(response.json().get("id"), None, "`id` key missing from response.")
+        for url in ["/api/maps/abc/", "/api/components/abc/", "/api/components/abc/subtree/", "/api/maps/99999/"]:
+            self.assertEqual(self.client.get(url).status_code, 404, f"{url} did not return 404")
+
+    def test_conditional_requests(self):
+        """Tests that detail and list views return validators and 304 responses for unchanged objects."""
+        map = ArrangementMap.objects.filter(components__isnull=False).distinct().first()
+        component = map.components.first()
+        ArrangementMapComponent.objects.create(title=get_title_string(), map=map, tree_index=98).delete()
+        map_url = reverse("arrangementmap-detail", kwargs={"pk": map.pk})
+        component_url = reverse("arrangementmapcomponent-detail", kwargs={"pk": component.pk})
+        list_urls = [reverse("arrangementmap-list"), reverse("arrangementmapcomponent-list"), reverse("delete-feed")]
+        urls = [map_url, component_url] + list_urls
+        responses = {url: self.client.get(url) for url in urls}
+        for url, response in responses.items():
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response["ETag"].startswith('"'), f"Strong ETag missing for {url}")
+            self.assertIn("Last-Modified", response)
+            with CaptureQueriesContext(connection) as queries:
+                not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+            self.assertEqual(not_modified.status_code, 304, f"{url} was not validated by ETag")
+            self.assertEqual(not_modified["ETag"], response["ETag"])
+            self.assertEqual(len(queries), 1, f"Response for {url} was built before validation")
+            not_modified = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+            self.assertEqual(not_modified.status_code, 304, f"{url} was not validated by Last-Modified")
+        self.assertNotEqual(
+            self.client.get(f"{list_urls[0]}?limit=1")["ETag"], responses[list_urls[0]]["ETag"],
+            "ETag does not depend on the query string")
+
+        time.sleep(0.01)
+        ArrangementMapComponent.objects.create(title=get_title_string(), map=map, parent=component, tree_index=99)
+        for url in [map_url, component_url, list_urls[1]]:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=responses[url]["ETag"])
+            self.assertEqual(response.status_code, 200, f"Changed response for {url} was not returned")
+            self.assertNotEqual(response["ETag"], responses[url]["ETag"])
+        ArrangementMapComponent.objects.filter(map=map).last().delete()
+        response = self.client.get(list_urls[2], HTTP_IF_NONE_MATCH=responses[list_urls[2]]["ETag"])
+        self.assertEqual(response.status_code, 200, "Changed delete feed was not returned")
+
+    def test_tree_depth(self):
+        """Tests depth-limited map trees and component subtrees."""
+        map = build_map(get_title_string(), 40, 3, 4)
+        request = self.factory.get(reverse("arrangementmap-detail", kwargs={"pk": map.pk}), format="json")
+        full = json.loads(ArrangementMapViewset.as_view(actions={"get": "retrieve"})(request, pk=map.pk).content)["children"]
+
+        def count(node):
+            return sum(1 + count(child) for child in node.get("children", []))
+
+        def prune(nodes, depth):
+            pruned = []
+            for node in nodes:
+                node = dict(node)
+                children = node.pop("children", [])
+                if depth > 1:
+                    if children:
+                        node["children"] = prune(children, depth - 1)
+                elif children:
+                    node.update(has_children=True, descendant_count=sum(1 + count(c) for c in children))
+                pruned.append(node)
+            return pruned
+
+        for depth in [1, 2, 3]:
+            request = self.factory.get(
+                f"{reverse('arrangementmap-detail', kwargs={'pk': map.pk})}?depth={depth}", format="json")
+            with self.assertNumQueries(3):
+                response = ArrangementMapViewset.as_view(actions={"get": "retrieve"})(request, pk=map.pk)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data["children"], prune(full, depth))
+
+        parent = full[0]
+        for depth in [1, 2]:
+            request = self.factory.get(
+                f"{reverse('arrangementmapcomponent-subtree', kwargs={'pk': parent['id']})}?depth={depth}",
+                format="json")
+            with self.assertNumQueries(2):
+                response = ArrangementMapComponentViewset.as_view(actions={"get": "subtree"})(request, pk=parent["id"])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, prune([parent], depth + 1)[0])
+
+        for depth in ["0", "two"]:
+            request = self.factory.get(
+                f"{reverse('arrangementmapcomponent-subtree', kwargs={'pk': parent['id']})}?depth={depth}",
+                format="json")
+            response = ArrangementMapComponentViewset.as_view(actions={"get": "subtree"})(request, pk=parent["id"])
+            self.assertEqual(response.status_code, 400)
+
+    def test_compact_format(self):
+        """Tests that the compact format holds the same tree as the nested one, and that responses are compressed."""
+        map = build_map(get_title_string(), 40, 3, 4)
+        ArrangementMapComponent.objects.filter(map=map).update(child_count=5)
+        url = reverse("arrangementmap-detail", kwargs={"pk": map.pk})
+        request = self.factory.get(url, format="json")
+        nested = json.loads(ArrangementMapViewset.as_view(actions={"get": "retrieve"})(request, pk=map.pk).content)
+        request = self.factory.get(f"{url}?format=compact")
+        # Validators, the map and its components
+        with self.assertNumQueries(3):
+            response = ArrangementMapViewset.as_view(actions={"get": "retrieve"})(request, pk=map.pk)
+            response.render()
+        self.assertEqual(response.status_code, 200)
+        compact = json.loads(response.content)
+        self.assertEqual({k: v for k, v in compact.items() if k != "components"},
+                         {k: v for k, v in nested.items() if k != "children"})
+
+        columns = compact["components"]
+        self.assertEqual(set(columns), {"id", "parent_index", "title", "level", "archivesspace_uri", "order", "child_count"})
+        self.assertEqual(columns["child_count"], [5] * 40)
+        rebuilt = []
+        nodes = []
+        for index, pk in enumerate(columns["id"]):
+            node = {"id": pk, "title": columns["title"][index], "level": columns["level"][index],
+                    "archivesspace_uri": columns["archivesspace_uri"][index], "order": columns["order"][index]}
+            parent_index = columns["parent_index"][index]
+            siblings = rebuilt if parent_index is None else nodes[parent_index].setdefault("children", [])
+            siblings.append(node)
+            nodes.append(node)
+
+        def strip(node):
+            stripped = {k: node[k] for k in ("id", "title", "level", "archivesspace_uri", "order")}
+            if node.get("children"):
+                stripped["children"] = [strip(child) for child in node["children"]]
+            return stripped
+        self.assertEqual(rebuilt, [strip(node) for node in nested["children"]])
+
+        request = self.factory.get(f"{url}?format=compact", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(ArrangementMapViewset.as_view(actions={"get": "retrieve"})(request, pk=map.pk).status_code, 304)
+        with ArchivesSpaceStub(child_count=7) as stub:
+            with patch.dict(settings.ASPACE, {"baseurl": stub.baseurl}):
+                run_job(enqueue("update_child_counts", component_ids=columns["id"]))
+        response = ArrangementMapViewset.as_view(actions={"get": "retrieve"})(request, pk=map.pk)
+        self.assertEqual(response.status_code, 200, "Changed child counts were not revalidated")
+        self.assertEqual(response.data["components"]["child_count"], [7] * 40)
+
+        request = self.factory.get(f"{url}?format=compact&depth=1")
+        self.assertEqual(ArrangementMapViewset.as_view(actions={"get": "retrieve"})(request, pk=map.pk).status_code, 400)
+        request = self.factory.get(f"{reverse('arrangementmap-list')}?format=compact")
+        self.assertEqual(ArrangementMapViewset.as_view(actions={"get": "list"})(request).status_code, 404)
+
+        nested = ArrangementMapViewset.as_view(actions={"get": "retrieve"})(self.factory.get(url), pk=map.pk).content
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.content), nested)
+
+    def test_map_snapshots(self):
+        """Tests that ArrangementMap snapshots are built, refreshed and served."""
+        map = random.choice(ArrangementMap.objects.all())
+        request = self.factory.get(reverse('arrangementmap-detail', kwargs={"pk": map.pk}), format="json")
+        response = ArrangementMapViewset.as_view(actions={"get": "retrieve"})(request, pk=map.pk)
+        self.assertEqual(response.status_code, 200, f"Error in map detail view: {response.content}")
+        self.assertTrue(ArrangementMapSnapshot.objects.get(map=map).is_current, "Snapshot was not built")
+        self.assertEqual(response.content, JSONRenderer().render(ArrangementMapSerializer(map).data),
+                         "Snapshot does not match serialized map")
+        request = self.factory.get(reverse('arrangementmap-detail', kwargs={"pk": map.pk}), HTTP_ACCEPT="text/html")
+        response = ArrangementMapViewset.as_view(actions={"get": "retrieve"})(request, pk=map.pk)
+        self.assertEqual(response.data, ArrangementMapSerializer(map).data, "Snapshot was not parsed for the browsable API")
+
+        Job.objects.all().delete()
+        components = [ArrangementMapComponent.objects.create(title=get_title_string(), map=map, tree_index=99 + i)
+                      for i in range(3)]
+        self.assertFalse(ArrangementMapSnapshot.objects.get(map=map).is_current, "Snapshot was rebuilt in the request")
+        job = Job.objects.get(task="refresh_map_snapshot")
+        self.assertEqual(job.arguments, {"map_id": map.pk})
+        run_job(claim_job())
+        self.assertTrue(ArrangementMapSnapshot.objects.get(map=map).is_current, "Snapshot was not rebuilt by its job")
+        request = self.factory.get(reverse('arrangementmap-detail', kwargs={"pk": map.pk}), format="json")
+        response = ArrangementMapViewset.as_view(actions={"get": "retrieve"})(request, pk=map.pk)
+        self.assertIn(components[0].pk, [c["id"] for c in json.loads(response.content)["children"]],
+                      "New component missing from snapshot")
+
+        ArrangementMapSnapshot.objects.all().delete()
+        call_command("warm_map_snapshots", stdout=open(os.devnull, "w"))
+        self.assertEqual(ArrangementMapSnapshot.objects.count(), ArrangementMap.objects.count(), "Snapshots were not warmed")
+
+    def test_export(self):
+        """Tests the streaming export of published maps, from the view and the management command."""
+        ArrangementMap.objects.update(publish=True)
+        ArrangementMap.objects.filter(pk=ArrangementMap.objects.order_by("pk")[0].pk).update(publish=False)
+        published = ArrangementMap.objects.filter(publish=True)
+
+        response = self.client.get(reverse('export'))
+        self.assertEqual(response.status_code, 200, "Wrong HTTP status code")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).splitlines()
+        self.assertEqual(
+            [json.loads(line)["id"] for line in lines],
+            list(published.order_by("modified", "pk").values_list("pk", flat=True)))
+        self.assertEqual(json.loads(lines[0]), ArrangementMapSerializer(published.order_by("modified", "pk")[0]).data)
+
+        output = StringIO()
+        call_command("export_maps", stdout=output)
+        self.assertEqual(output.getvalue().encode().splitlines(), lines, "Command output does not match view")
+
+        response = self.client.get(f"{reverse('export')}?modified_since={int(time.time()) + 60}")
+        self.assertEqual(b"".join(response.streaming_content), b"", "Unmodified maps were exported")
+
+        with patch.object(settings, "ASGI", True):
+            response = self.client.get(reverse('export'))
+        self.assertTrue(response.is_async, "Export is not streamed asynchronously under ASGI")
+        self.assertEqual(async_to_sync(self.read_async)(response), b"\n".join(lines) + b"\n")
+
+    async def read_async(self, response):
+        return b"".join([chunk async for chunk in response.streaming_content])
+
+    def test_change_feed_view(self):
+        """Tests that changes are logged in order and can be consumed from a sequence number."""
+        since = Change.objects.order_by("-sequence").values_list("sequence", flat=True).first() or 0
+        with self.captureOnCommitCallbacks(execute=True):
+            map = ArrangementMap.objects.create(title=get_title_string())
+            component = ArrangementMapComponent.objects.create(title=get_title_string(), map=map, tree_index=0)
+            component.title = get_title_string()
+            component.save()
+            tree = ArrangementMapSerializer(map).data["children"]
+            tree[0]["title"] = get_title_string()
+            ArrangementMapViewset.as_view(actions={"put": "tree"})(
+                self.factory.put(reverse("arrangementmap-tree", kwargs={"pk": map.pk}), format="json",
+                                 data={"children": tree}), pk=map.pk)
+            component_ref = reverse("arrangementmapcomponent-detail", kwargs={"pk": component.pk})
+            component.delete()
+            with transaction.atomic():
+                ArrangementMap.objects.create(title=get_title_string())
+                transaction.set_rollback(True)
+        map_ref = reverse("arrangementmap-detail", kwargs={"pk": map.pk})
+        expected = [
+            ("create", map_ref),
+            ("create", component_ref), ("update", map_ref),
+            ("update", component_ref), ("update", map_ref),
+            ("update", component_ref), ("update", map_ref),
+            ("delete", component_ref), ("update", map_ref)]
+
+        response = self.client.get(f"{reverse('change-feed')}?since={since}", format="json")
+        self.assertEqual(response.status_code, 200, "Wrong HTTP status code")
+        self.assertEqual([(c["action"], c["ref"]) for c in response.data["results"]], expected)
+        self.assertIsNone(response.data["next"])
+
+        changes = []
+        response = self.client.get(f"{reverse('change-feed')}?since={since}&limit=2", format="json")
+        while response.data["next"]:
+            changes += response.data["results"]
+            response = self.client.get(response.data["next"], format="json")
+        changes += response.data["results"]
+        self.assertEqual([(c["action"], c["ref"]) for c in changes], expected, "Changes were skipped when paging")
+        sequences = [c["sequence"] for c in changes]
+        self.assertEqual(sequences, sorted(set(sequences)), "Sequence numbers are not increasing")
+
+        response = self.client.get(f"{reverse('change-feed')}?since={sequences[-1]}", format="json")
+        self.assertEqual(response.data["results"], [], "Changes were returned after the last sequence number")
+
+        for limit in (0, -1):
+            response = self.client.get(f"{reverse('change-feed')}?limit={limit}", format="json")
+            self.assertEqual(response.status_code, 400, f"Limit of {limit} was accepted")
+        with patch.object(settings, "CHANGE_FEED_MAX_LIMIT", 2):
+            response = self.client.get(f"{reverse('change-feed')}?since={since}&limit=1000000", format="json")
+        self.assertEqual(len(response.data["results"]), 2, "Limit was not capped")
+
+        Change.objects.filter(ref=map_ref).delete()
+        import_module("maps.migrations.0013_backfill_changes").backfill_changes(apps, None)
+        self.assertEqual(Change.objects.filter(action="create", ref=map_ref).count(), 1, "Existing map was not backfilled")
+        self.assertEqual(Change.objects.filter(action="create").count(),
+                         ArrangementMap.objects.count() + ArrangementMapComponent.objects.count() + 1,
+                         "Objects were not backfilled exactly once")
 
     def test_delete_feed_view(self):
         """Tests DeleteFeed views."""
@@ -144,6 +744,42 @@ class CartographerTest(TestCase):
             format="json")
         self.assertEqual(time_response.status_code, 200, "Wrong HTTP status code")
 
+    def page_by_cursor(self, url, on_page=None, key="id"):
+        """Follows `next` links from a cursor-paginated list, returning result ids."""
+        ids = []
+        response = self.client.get(f"{url}?cursor=&limit=3", format="json")
+        while True:
+            self.assertEqual(response.status_code, 200, f"Request error: {response.data}")
+            self.assertNotIn("count", response.data)
+            ids += [obj[key] for obj in response.data["results"]]
+            if on_page:
+                on_page()
+            if not response.data["next"]:
+                return ids
+            response = self.client.get(response.data["next"], format="json")
+
+    def test_keyset_pagination(self):
+        """Tests that cursor pagination returns every object once, even when objects change."""
+        expected = sorted(ArrangementMapComponent.objects.values_list("pk", flat=True))
+        self.assertEqual(sorted(self.page_by_cursor(reverse('arrangementmapcomponent-list'))), expected)
+
+        untouched = list(expected)
+
+        def touch_component():
+            """Saves a component which has not been returned yet."""
+            ArrangementMapComponent.objects.get(pk=untouched.pop()).save()
+        ids = self.page_by_cursor(reverse('arrangementmapcomponent-list'), on_page=touch_component)
+        self.assertEqual(len(ids), len(set(ids)), "Objects were returned more than once")
+        self.assertEqual(sorted(ids), expected, "Objects were skipped")
+
+        ArrangementMapComponent.objects.all().delete()
+        refs = self.page_by_cursor(reverse('delete-feed'), key="ref")
+        self.assertEqual(len(refs), DeletedArrangementMap.objects.count())
+        self.assertEqual(len(refs), len(set(refs)), "Deleted objects were returned more than once")
+
+        response = self.client.get(f"{reverse('arrangementmap-list')}?cursor=invalid", format="json")
+        self.assertEqual(response.status_code, 404, "Invalid cursor was accepted")
+
     def test_find_by_uri_view(self):
         """Tests FindByURIView."""
         map = random.choice(ArrangementMapComponent.objects.all())
@@ -155,6 +791,68 @@ class CartographerTest(TestCase):
             response.data["count"] >= 1,
             f"Response count is {response.data['count']}, should have been at least 1")
 
+    def test_find_by_uri_batch_view(self):
+        """Tests FindByURIBatchView, for GET and POST requests."""
+        for i, component in enumerate(ArrangementMapComponent.objects.all()):
+            ArrangementMapComponent.objects.filter(pk=component.pk).update(
+                archivesspace_uri=f"/repositories/2/resources/{i % 3 + 1}")
+        uris = [f"/repositories/2/resources/{i}" for i in range(1, 4)]
+        missing = "/repositories/2/resources/999999"
+        query_counts = []
+        for submitted in [uris[:1], uris + [missing]]:
+            query = "&".join(f"uri={uri}" for uri in submitted)
+            request = self.factory.get(f"{reverse('find-by-uri-batch')}?{query}", format="json")
+            with CaptureQueriesContext(connection) as queries:
+                response = FindByURIBatchView.as_view()(request)
+            self.assertEqual(response.status_code, 200, f"FindByURIBatch error: {response.data}")
+            query_counts.append(len(queries))
+            self.assertEqual(list(response.data), submitted)
+        # Components, their children and their ancestors
+        self.assertLessEqual(max(query_counts), 3, "Queries grew with the number of URIs")
+        self.assertEqual(response.data[missing], [])
+        for uri in uris:
+            request = self.factory.get(f"{reverse('find-by-uri')}?uri={uri}&limit=1000", format="json")
+            expected = FindByURIView.as_view()(request).data["results"]
+            self.assertEqual(response.data[uri], expected, f"Results for {uri} do not match FindByURIView")
+
+        request = self.factory.post(reverse('find-by-uri-batch'), {"uris": uris}, format="json")
+        post_response = FindByURIBatchView.as_view()(request)
+        self.assertEqual(post_response.status_code, 200, f"FindByURIBatch error: {post_response.data}")
+        self.assertEqual(post_response.data, {uri: response.data[uri] for uri in uris})
+        for data in [{}, {"uris": "/repositories/2/resources/1"}, {"uris": ["/r/1"] * (settings.FIND_BY_URI_MAX_URIS + 1)}]:
+            request = self.factory.post(reverse('find-by-uri-batch'), data, format="json")
+            self.assertEqual(FindByURIBatchView.as_view()(request).status_code, 400)
+
+    def test_component_query_count(self):
+        """Tests that ancestors and children are loaded in a constant number of queries."""
+        map = ArrangementMap.objects.create(title=get_title_string())
+        uri = "/repositories/2/resources/99"
+        parent = None
+        for depth in [5, 15]:
+            while ArrangementMapComponent.objects.filter(map=map).count() < depth:
+                parent = ArrangementMapComponent.objects.create(
+                    title=get_title_string(), map=map, tree_index=0, parent=parent)
+                ArrangementMapComponent.objects.create(title=get_title_string(), map=map, tree_index=1, parent=parent)
+            ArrangementMapComponent.objects.filter(map=map).update(archivesspace_uri=uri)
+            request = self.factory.get(f"{reverse('find-by-uri')}?uri={uri}", format="json")
+            with self.assertNumQueries(4):
+                response = FindByURIView.as_view()(request)
+            self.assertEqual(response.status_code, 200, f"FindByURI error: {response.data}")
+            for result in response.data["results"]:
+                component = ArrangementMapComponent.objects.get(pk=result["id"])
+                expected = []
+                while component.parent:
+                    component = component.parent
+                    expected.append(component.pk)
+                self.assertEqual([a["ref"] for a in result["ancestors"]],
+                                 [reverse("arrangementmapcomponent-detail", kwargs={"pk": pk}) for pk in expected])
+            obj = ArrangementMapComponent.objects.filter(map=map).order_by("-level").first()
+            request = self.factory.get(reverse("arrangementmapcomponent-detail", kwargs={"pk": obj.pk}), format="json")
+            # Validators, the component with its map, children and ancestors
+            with self.assertNumQueries(4):
+                response = ArrangementMapComponentViewset.as_view(actions={"get": "retrieve"})(request, pk=obj.pk)
+            self.assertEqual(len(response.data["ancestors"]), obj.level)
+
     def test_objects_before_view(self):
         """Tests objects_before action view"""
         obj = random.choice(ArrangementMapComponent.objects.all())
@@ -163,6 +861,19 @@ class CartographerTest(TestCase):
         self.assertEqual(response.status_code, 200, f"Error in objects_before action view: {response.data}")
         self.assertTrue(isinstance(response.data["count"], int))
 
+    def test_map_objects_before_view(self):
+        """Tests objects_before action view for a whole map."""
+        map = random.choice(ArrangementMap.objects.filter(components__isnull=False).distinct())
+        ArrangementMapComponent.objects.filter(map=map).update(child_count=3)
+        request = self.factory.get(reverse("arrangementmap-objects-before", args=[map.pk]), format="json")
+        response = ArrangementMapViewset.as_view(actions={"get": "objects_before"})(request, pk=map.pk)
+        self.assertEqual(response.status_code, 200, f"Error in objects_before action view: {response.data}")
+        for obj in ArrangementMapComponent.objects.filter(map=map):
+            request = self.factory.get(reverse("arrangementmapcomponent-objects-before", args=[obj.pk]), format="json")
+            with self.assertNumQueries(2):
+                component_response = ArrangementMapComponentViewset.as_view(actions={"get": "objects_before"})(request, pk=obj.pk)
+            self.assertEqual(response.data["counts"][obj.pk], component_response.data["count"])
+
     def test_resource_fetcher_view(self):
         """Tests ResourceFetcherView."""
         with edit_vcr.use_cassette("resource-fetcher.json"):
@@ -173,6 +884,223 @@ class CartographerTest(TestCase):
             self.assertEqual(not_found.status_code, 404)
             self.assertTrue(isinstance(not_found.json(), str))
 
+    def test_resource_fetcher_cache(self):
+        """Tests caching and revalidation of resources in ResourceFetcherView."""
+        uri = f"/repositories/{settings.ASPACE['repo_id']}/resources/1"
+        url = reverse("fetch-resource", kwargs={"resource_id": 1})
+        with ArchivesSpaceStub(records={uri: {"uri": uri, "publish": True, "system_mtime": "2021-06-15T17:44:43Z"}}) as stub:
+            with patch.dict(settings.ASPACE, {"baseurl": stub.baseurl}):
+                self.assertEqual(self.client.get(url)["X-Cache"], "MISS")
+                self.assertEqual(self.client.get(url)["X-Cache"], "HIT")
+                self.assertEqual(self.client.get(f"{url}?refresh")["X-Cache"], "MISS", "Cache was not bypassed")
+                with patch.object(settings, "RESOURCE_CACHE_REVALIDATE_AFTER", 0):
+                    self.assertEqual(self.client.get(url)["X-Cache"], "REVALIDATED")
+                    get_client().post(uri, json={"uri": uri, "publish": False})
+                    response = self.client.get(url)
+                    self.assertEqual(response["X-Cache"], "MISS", "Changed resource was not fetched again")
+                    self.assertFalse(response.json()["publish"], "Stale resource was returned")
+        self.assertEqual(stub.count("GET", f"^{uri}$"), 3, "Wrong number of resource fetches")
+        stats = self.client.get(reverse("fetch-resource-stats")).json()
+        self.assertEqual(stats, resource_cache_stats())
+        self.assertEqual(stats, {"hits": 1, "revalidated": 1, "misses": 3})
+
+    async def test_resource_fetcher_concurrency(self):
+        """Tests that resource requests wait on a slow ArchivesSpace concurrently,
+        over a limited number of reused connections."""
+        uris = [f"/repositories/{settings.ASPACE['repo_id']}/resources/{i}" for i in range(1, 41)]
+        latency = 0.2
+        with ArchivesSpaceStub(records={uri: {"uri": uri} for uri in uris}, latency=latency) as stub, \
+                patch.dict(settings.ASPACE, {"baseurl": stub.baseurl}), \
+                patch.object(settings, "ASPACE_ASYNC_MAX_CONNECTIONS", 10):
+            view = AsyncResourceFetcherView.as_view()
+            start = time.perf_counter()
+            responses = await asyncio.gather(*(
+                view(AsyncRequestFactory().get("/?refresh"), resource_id=i) for i in range(1, len(uris) + 1)))
+            elapsed = time.perf_counter() - start
+            client = get_async_client()
+            with patch.dict(settings.ASPACE, {"username": "other"}):
+                self.assertIsNot(get_async_client(), client)
+                for _ in range(5):
+                    await asyncio.sleep(0)
+        self.assertTrue(client.session.is_closed, "Replaced client was not closed")
+        self.assertEqual([r.status_code for r in responses], [200] * len(uris))
+        self.assertEqual([json.loads(r.content)["uri"] for r in responses], uris)
+        self.assertEqual(stub.count("POST", "/login$"), 1, "Client logged in more than once")
+        self.assertEqual(stub.max_active, 10, "Concurrent requests were not limited")
+        self.assertLessEqual(len(stub.connections), 10, "Connections were not reused")
+        # A login and four rounds of ten requests, rather than forty in turn
+        self.assertLess(elapsed, latency * 15)
+
+    def get_metric(self, name):
+        """Returns the value of a metric served at /metrics, or 0 if it has not been recorded."""
+        for line in self.client.get(reverse("metrics")).content.decode().splitlines():
+            if line.startswith(f"{name} "):
+                return float(line.split()[-1])
+        return 0
+
+    def test_request_metrics(self):
+        """Tests that request metrics are returned in headers, logged and served at /metrics."""
+        queries_metric = 'cartographer_db_queries_sum{view="arrangementmapcomponent-list",method="GET"}'
+        requests_metric = 'cartographer_archivesspace_requests_sum{view="fetch-resource",method="GET"}'
+        previous_queries, previous_requests = self.get_metric(queries_metric), self.get_metric(requests_metric)
+        with self.assertLogs("maps.middleware", level="DEBUG") as logs:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse("arrangementmapcomponent-list"))
+        query_count = len(queries)
+        timings = dict(timing.split(";", 1) for timing in response["Server-Timing"].split(", "))
+        self.assertEqual(set(timings), {"db", "archivesspace", "serialize", "render", "total"})
+        self.assertIn(f'desc="{query_count} queries"', timings["db"])
+        self.assertIn('desc="0 requests"', timings["archivesspace"])
+        log = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(log["view"], "arrangementmapcomponent-list")
+        self.assertEqual(log["db_queries"], query_count)
+        self.assertGreater(log["serialize_ms"] + log["render_ms"], 0)
+
+        uri = f"/repositories/{settings.ASPACE['repo_id']}/resources/1"
+        with ArchivesSpaceStub(records={uri: {"uri": uri, "system_mtime": "2021-06-15T17:44:43Z"}}) as stub:
+            with patch.dict(settings.ASPACE, {"baseurl": stub.baseurl}):
+                response = self.client.get(reverse("fetch-resource", kwargs={"resource_id": 1}))
+                client_stats = get_client().stats
+        self.assertIn(f'desc="{len(stub.requests)} requests"', response["Server-Timing"])
+
+        metrics = self.client.get(reverse("metrics"))
+        self.assertEqual(metrics.status_code, 200)
+        self.assertTrue(metrics["Content-Type"].startswith("text/plain"))
+        self.assertIn("# TYPE cartographer_request_duration_seconds histogram", metrics.content.decode())
+        self.assertEqual(self.get_metric(queries_metric), previous_queries + query_count)
+        self.assertEqual(self.get_metric(requests_metric), previous_requests + len(stub.requests))
+        self.assertEqual(self.get_metric("cartographer_archivesspace_logins_total"), client_stats["logins"])
+        self.assertEqual(self.get_metric("cartographer_archivesspace_client_requests_total"), client_stats["requests"])
+        self.assertEqual(self.get_metric("cartographer_archivesspace_connections_total"), 1, "Connections were not reused")
+
+    def test_profiling(self):
+        """Tests that requests are profiled for staff users or by sampling, and listed in the admin."""
+        url = f"{reverse('arrangementmapcomponent-list')}?profile"
+        with tempfile.TemporaryDirectory() as profile_dir, patch.object(settings, "PROFILE_DIR", profile_dir):
+            self.assertNotIn("X-Profile", self.client.get(url), "Request was profiled for anonymous user")
+            user = get_user_model().objects.create_user("staff", is_staff=True)
+            self.client.force_login(user)
+            names = [self.client.get(url)["X-Profile"] for _ in range(3)]
+            with patch.object(settings, "PROFILE_SAMPLE_RATE", 1):
+                self.client.logout()
+                names.append(self.client.get(reverse('arrangementmap-list'))["X-Profile"])
+            self.assertEqual(len(os.listdir(profile_dir)), 8)
+
+            with patch.object(settings, "PROFILE_MAX_COUNT", 2):
+                self.client.force_login(user)
+                names.append(self.client.get(url)["X-Profile"])
+            self.assertEqual(sorted(os.listdir(profile_dir)),
+                             sorted(f"{name}.{ext}" for name in names[-2:] for ext in ["json", "prof"]),
+                             "Oldest profiles were not removed")
+
+            response = self.client.get(reverse("profile-list"))
+            self.assertEqual(response.status_code, 200)
+            durations = [profile["duration_ms"] for profile in response.context["profiles"]]
+            self.assertEqual(durations, sorted(durations, reverse=True), "Profiles are not sorted by cost")
+            response = self.client.get(reverse("profile-detail", kwargs={"name": names[-1]}))
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("cumulative", response.context["profile"]["stats"])
+            self.assertTrue(response.context["profile"]["queries"], "Queries were not recorded")
+            self.assertEqual(
+                self.client.get(reverse("profile-detail", kwargs={"name": "missing"})).status_code, 404)
+
+    def test_benchmark(self):
+        """Tests that the benchmark command reports results without keeping its synthetic maps."""
+        maps = ArrangementMap.objects.count()
+        output = StringIO()
+        call_command("benchmark", "--maps=2", "--size=40", "--depth=3", "--fanout=4", "--iterations=2", stdout=output)
+        results = json.loads(output.getvalue())
+        self.assertEqual(results["parameters"]["size"], 40)
+        for name in ["map_detail", "component_list", "find_by_uri_batch", "export", "delete_feed_last_page",
+                     "delete_feed_cursor_last_page", "publish_map"]:
+            self.assertEqual(results["results"][name]["runs"], 2, f"{name} was not benchmarked")
+            self.assertGreaterEqual(results["results"][name]["latency_ms"]["p99"],
+                                    results["results"][name]["latency_ms"]["p50"])
+        self.assertGreater(results["results"]["publish_map"]["archivesspace_requests"], 0)
+        formats = results["results"]["map_formats"]
+        self.assertLess(formats["compact"]["bytes"], formats["nested"]["bytes"])
+        self.assertLessEqual(formats["compact"]["gzip_bytes"], formats["compact"]["bytes"])
+        self.assertEqual(ArrangementMap.objects.count(), maps, "Synthetic maps were not removed")
+
+    def test_replica_routing(self):
+        """Tests that safe requests read from replicas unless the client has written recently."""
+        router = ReplicaRouter()
+
+        def get_response(request):
+            if "batch" in request.GET:
+                middleware.process_view(request, FindByURIBatchView.as_view(), (), {})
+            reads.append(ArrangementMap.objects.all().db)
+            if "write" in request.GET:
+                router.db_for_write(ArrangementMap)
+                reads.append(ArrangementMap.objects.all().db)
+            return HttpResponse()
+
+        middleware = ReplicaMiddleware(get_response)
+        cases = [
+            (self.factory.get("/"), ["replica1"], False),
+            (self.factory.get("/?write"), ["replica1", "default"], True),
+            (self.factory.post("/"), ["default"], False),
+            (self.factory.post("/?write"), ["default", "default"], True),
+            (self.factory.post("/?batch"), ["replica1"], False),
+        ]
+        pinned = self.factory.get("/")
+        pinned.COOKIES[settings.REPLICA_PIN_COOKIE] = "1"
+        cases.append((pinned, ["default"], False))
+        with patch.object(settings, "DATABASE_REPLICAS", ["replica1"]):
+            for request, expected, pins in cases:
+                reads = []
+                response = middleware(request)
+                self.assertEqual(reads, expected, f"Wrong databases for {request.method} {request.get_full_path()}")
+                self.assertEqual(settings.REPLICA_PIN_COOKIE in response.cookies, pins)
+                if pins:
+                    cookie = response.cookies[settings.REPLICA_PIN_COOKIE]
+                    self.assertEqual((cookie["samesite"], cookie["secure"]), ("None", True), "Pin is not sent cross-origin")
+        self.assertEqual(ArrangementMap.objects.all().db, "default", "Reads outside requests used a replica")
+        with patch.object(settings, "DATABASE_REPLICAS", ["replica1", "replica2"]), read_from_replicas():
+            self.assertEqual(len({ArrangementMap.objects.all().db for _ in range(20)}), 1,
+                             "Reads in one request used different replicas")
+
+        reads = []
+        response = middleware(self.factory.post("/?write"))
+        self.assertEqual(reads, ["default", "default"])
+        self.assertNotIn(settings.REPLICA_PIN_COOKIE, response.cookies, "Client was pinned without replicas")
+
+        map = ArrangementMap.objects.get(pk=1)
+        ArrangementMapSnapshot.objects.filter(map=map).delete()
+        map._state.db = "replica1"
+        self.assertEqual(json.loads(get_snapshot_json(map)), ArrangementMapSerializer(map).data)
+        self.assertFalse(ArrangementMapSnapshot.objects.filter(map=map).exists(), "Snapshot was built from a replica")
+
     def test_ping(self):
         ping = self.client.get(reverse('ping'))
         self.assertEqual(ping.status_code, 200, "Wrong HTTP code")
+
+
+class CartographerTransactionTest(TransactionTestCase):
+    """Tests behavior which depends on transactions being committed."""
+
+    fixtures = ["initial.json"]
+
+    def test_child_count_without_transaction(self):
+        """Tests that a child count update is enqueued for a component created outside a transaction."""
+        map = ArrangementMap.objects.first()
+        response = self.client.post(
+            reverse("arrangementmapcomponent-list"),
+            {"title": get_title_string(), "map": map.pk, "order": 0, "level": "series",
+             "archivesspace_uri": "/repositories/2/resources/1"},
+            content_type="application/json")
+        self.assertEqual(response.status_code, 201, f"Error creating component: {response.content}")
+        job = Job.objects.get(task="update_child_counts")
+        self.assertEqual(job.arguments, {"component_ids": [response.json()["id"]]})
+
+        components = list(ArrangementMapComponent.objects.exclude(pk=response.json()["id"])[:2])
+        try:
+            with transaction.atomic():
+                schedule_child_count(components[0].pk)
+                raise ValueError
+        except ValueError:
+            pass
+        with transaction.atomic():
+            schedule_child_count(components[1].pk)
+        job = Job.objects.filter(task="update_child_counts").latest("pk")
+        self.assertEqual(job.arguments, {"component_ids": [components[1].pk]}, "Rolled back component was scheduled")
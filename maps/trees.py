@@ -0,0 +1,118 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .jobs import schedule_child_count
+from .models import ArrangementMapComponent, Change
+from .signals import batch_component_signals, log_change
+
+FIELDS = {
+    'title': 'title',
+    'level': 'archivesspace_level',
+    'archivesspace_uri': 'archivesspace_uri',
+    'order': 'tree_index',
+}
+
+
+def flatten(nodes, parent=None):
+    """Yields each node of a nested tree with its parent, parents first."""
+    for node in nodes:
+        if not isinstance(node, dict):
+            raise ValidationError("Tree nodes must be objects.")
+        yield node, parent
+        yield from flatten(node.get('children') or [], node)
+
+
+def get_fields(node):
+    """Returns the model fields set by a node, cleaned by their model fields so
+    that invalid values are rejected before they are written."""
+    fields = {}
+    for key, field in FIELDS.items():
+        if key in node:
+            try:
+                fields[field] = ArrangementMapComponent._meta.get_field(field).clean(node[key], None)
+            except DjangoValidationError as e:
+                raise ValidationError({key: e.messages})
+    return fields
+
+
+@transaction.atomic
+def replace_tree(map, tree):
+    """Replaces the components of an ArrangementMap with a nested tree.
+
+    The tree has the shape of the `children` of ArrangementMapSerializer.
+    Nodes with an `id` are existing components and nodes without one are
+    inserted. Existing components missing from the tree are deleted.
+
+    Only changed components are written: inserts and moves are applied one
+    node at a time with MPTT, deleted subtrees are removed from their top
+    node, and field changes are written with a single bulk update. Signals
+    are batched, so the map is saved once and tombstones are created with a
+    single insert.
+
+    Returns lists of the ids of inserted, moved, updated and deleted
+    components.
+    """
+    current = {c.pk: c for c in ArrangementMapComponent.objects.filter(map=map)}
+    desired = list(flatten(tree))
+    ids = [node['id'] for node, _ in desired if node.get('id') is not None]
+    if not all(isinstance(pk, int) for pk in ids):
+        raise ValidationError("Component ids must be integers.")
+    if len(ids) != len(set(ids)):
+        raise ValidationError("Component ids must only appear once in the tree.")
+    unknown = set(ids) - set(current)
+    if unknown:
+        raise ValidationError(f"Components {sorted(unknown)} do not belong to map {map.pk}.")
+
+    summary = {'inserted': [], 'moved': [], 'updated': [], 'deleted': []}
+    inserted = {}
+
+    def get_pk(node):
+        return node['id'] if node.get('id') is not None else inserted[id(node)]
+
+    def get_node(pk):
+        return ArrangementMapComponent.objects.get(pk=pk) if pk else None
+
+    with batch_component_signals() as batch:
+        for node, parent in desired:
+            if node.get('id') is None:
+                component = ArrangementMapComponent(map=map, **get_fields(node))
+                component.insert_at(get_node(get_pk(parent) if parent else None), 'last-child', save=True)
+                inserted[id(node)] = component.pk
+                summary['inserted'].append(component.pk)
+
+        for node, parent in desired:
+            parent_pk = get_pk(parent) if parent else None
+            if node.get('id') is not None and current[node['id']].parent_id != parent_pk:
+                get_node(node['id']).move_to(get_node(parent_pk), 'last-child')
+                current[node['id']].parent_id = parent_pk
+                summary['moved'].append(node['id'])
+
+        deleted = set(current) - set(ids)
+        for pk in sorted(deleted):
+            if current[pk].parent_id not in deleted:
+                get_node(pk).delete()
+        summary['deleted'] = sorted(deleted)
+
+        changed = []
+        for node, _ in desired:
+            if node.get('id') is None:
+                continue
+            component = current[node['id']]
+            fields = {field: value for field, value in get_fields(node).items() if getattr(component, field) != value}
+            for field, value in fields.items():
+                setattr(component, field, value)
+            if fields.get('archivesspace_uri'):
+                schedule_child_count(component.pk)
+            if fields:
+                summary['updated'].append(component.pk)
+            if fields or component.pk in summary['moved']:
+                component.modified = timezone.now()
+                changed.append(component)
+        ArrangementMapComponent.objects.bulk_update(changed, list(FIELDS.values()) + ['modified'])
+        for component in changed:
+            log_change(Change.UPDATE, component)
+        if changed:
+            batch.map_ids.add(map.pk)
+    return summary
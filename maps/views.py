@@ -1,28 +1,49 @@
+import hashlib
 from datetime import datetime
 
-from asnake.aspace import ASpace
-from asnake.jsonmodel import JSONModelObject
 from django.core.exceptions import FieldError
-from django.db.models import Sum
-from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import Coalesce
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from django.utils.timezone import make_aware
+from django.views import View
 from rest_framework.decorators import action
 from rest_framework.exceptions import ParseError
-from rest_framework.generics import ListAPIView
+from rest_framework.generics import ListAPIView, get_object_or_404
+from rest_framework.mixins import RetrieveModelMixin
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.schemas.openapi import AutoSchema
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.views import APIView
-from rest_framework.viewsets import ModelViewSet
+from rest_framework.viewsets import GenericViewSet, ModelViewSet
 
 from cartographer_backend import settings
 
-from .models import (ArrangementMap, ArrangementMapComponent,
-                     DeletedArrangementMap)
-from .serializers import (ArrangementMapComponentListSerializer,
+from .archivesspace import (afetch_resource, client_metrics, fetch_resource,
+                            resource_cache_stats)
+from .jobs import enqueue
+from .metrics import render_metrics
+from .models import (ArrangementMap, ArrangementMapComponent, Change,
+                     DeletedArrangementMap, Job)
+from .renderers import CompactJSONRenderer
+from .serializers import (ArrangementMapCompactSerializer,
+                          ArrangementMapComponentBulkSerializer,
+                          ArrangementMapComponentListSerializer,
                           ArrangementMapComponentSerializer,
+                          ArrangementMapComponentTreeSerializer,
                           ArrangementMapListSerializer,
-                          ArrangementMapSerializer,
-                          DeletedArrangementMapSerializer)
+                          ArrangementMapSerializer, ChangeSerializer,
+                          DeletedArrangementMapSerializer, JobSerializer)
+from .signals import batch_component_signals
+from .snapshots import (aexport_maps, export_maps, get_snapshot_data,
+                        get_snapshot_json)
+from .trees import replace_tree
 
 
 def process_params(view):
@@ -40,18 +61,58 @@ def process_params(view):
         modified__gte=make_aware(datetime.fromtimestamp(modified_since))).order_by('title')
     if 'published' in view.request.query_params:
         try:
-            queryset.exclude(publish=False)
+            queryset = queryset.filter(publish=True)
         except FieldError:
-            queryset.exclude(map__publish=False)
+            queryset = queryset.filter(map__publish=True)
     return queryset
 
 
+def get_depth(request):
+    """Returns the number of tree levels requested by the `depth` parameter,
+    or None if it is absent."""
+    depth = request.query_params.get('depth')
+    if depth is None:
+        return None
+    try:
+        depth = int(depth)
+    except ValueError:
+        depth = 0
+    if depth < 1:
+        raise ParseError("`depth` must be a positive integer.")
+    return depth
+
+
+def conditional_response(request, build, last_modified, *values):
+    """Returns a 304 response if the client's copy of a response is current,
+    and otherwise the response returned by `build`.
+
+    The strong ETag is derived from the request and from `last_modified` and
+    `values`, which must change whenever the response would, so that it can be
+    checked without building the response.
+    """
+    etag = quote_etag(hashlib.sha1(repr((
+        request.get_full_path(), request.META.get('HTTP_ACCEPT'), last_modified, values)).encode()).hexdigest())
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = build()
+    if response.status_code in (200, 304):
+        response['ETag'] = etag
+        if timestamp:
+            response['Last-Modified'] = http_date(timestamp)
+    return response
+
+
 class ArrangementMapViewset(ModelViewSet):
     """ArrangementMap endpoints.
 
     retrieve:
         Returns data about an ArrangementMap object, identified by a primary key.
 
+        URL parameters:
+            `depth` - returns only this many levels of the component tree
+            `format` - `compact` returns components as parallel arrays
+
     list:
         Returns paginated data about all ArrangementMap objects. Allows for two
 
@@ -62,34 +123,121 @@ class ArrangementMapViewset(ModelViewSet):
     """
     model = ArrangementMap
 
+    def retrieve(self, request, *args, **kwargs):
+        """Overrides default retrieve method.
+
+        Returns the stored snapshot of the ArrangementMap rather than
+        serializing its component tree on every request. JSON responses are
+        the stored bytes, which are only parsed for other renderers. If
+        `depth` is given, only the top levels of the tree are serialized
+        instead, and with `?format=compact` components are returned as
+        parallel arrays. The map's `modified` time, which changes whenever any
+        of its components do, is used to validate conditional requests.
+        """
+        if request.accepted_renderer.format == CompactJSONRenderer.format:
+            if get_depth(request):
+                raise ParseError("`depth` cannot be used with the compact format.")
+
+            def build():
+                return Response(ArrangementMapCompactSerializer(
+                    self.get_object(), context=self.get_serializer_context()).data)
+        elif get_depth(request):
+            def build():
+                return Response(self.get_serializer(self.get_object()).data)
+        elif request.accepted_renderer.format == JSONRenderer.format:
+            def build():
+                return HttpResponse(get_snapshot_json(self.get_object()), content_type=JSONRenderer.media_type)
+        else:
+            def build():
+                return Response(get_snapshot_data(self.get_object()))
+        modified = get_object_or_404(self.get_queryset().values_list('modified', flat=True), pk=kwargs['pk'])
+        return conditional_response(request, build, modified)
+
+    def list(self, request, *args, **kwargs):
+        """Overrides default list method to validate conditional requests."""
+        latest = self.filter_queryset(self.get_queryset()).aggregate(modified=Max('modified'), count=Count('pk'))
+        return conditional_response(
+            request, lambda: super(ArrangementMapViewset, self).list(request, *args, **kwargs),
+            latest['modified'], latest['count'])
+
     def update(self, request, pk=None, *args, **kwargs):
         """Overrides default update method.
 
         Publishes or unpublishes resource records in ArchivesSpace based on
-        publish attribute of parent ArrangementMap.
+        publish attribute of parent ArrangementMap. Records are only updated
+        when the publish attribute of the map has changed, in which case the
+        update is run as a background Job and a 202 response with a reference
+        to that Job is returned.
         """
+        published = self.get_object().publish
         response = super(ArrangementMapViewset, self).update(request, *args, **kwargs)
-        try:
-            map = ArrangementMap.objects.get(pk=pk)
-            aspace = ASpace(baseurl=settings.ASPACE['baseurl'],
-                            username=settings.ASPACE['username'],
-                            password=settings.ASPACE['password'])
-            for component in ArrangementMapComponent.objects.filter(map=map):
-                resource = aspace.client.get(component.archivesspace_uri).json()
-                resource["publish"] = map.publish
-                updated = aspace.client.post(component.archivesspace_uri, json=resource)
-                updated.raise_for_status()
+        map = ArrangementMap.objects.get(pk=pk)
+        if map.publish == published:
             return response
-        except Exception as e:
-            return Response(f"Error handling publish action in ArchivesSpace: {e}", status=500)
+        job = enqueue('publish_map', map_id=map.pk)
+        response.data["job"] = reverse('job-detail', kwargs={'pk': job.pk})
+        response["Location"] = response.data["job"]
+        response.status_code = 202
+        return response
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        """Deletes the map and its components, creating their tombstones with
+        a single insert."""
+        with batch_component_signals():
+            instance.delete()
+
+    @action(detail=True, methods=['put'])
+    def tree(self, request, pk=None):
+        """Replaces the components of the map with a nested tree.
+
+        Accepts the `children` of the map detail response, either on its own
+        or as part of the full response. Only components which have changed
+        are written, and the response lists the ids of inserted, moved,
+        updated and deleted components.
+        """
+        tree = request.data.get('children') if isinstance(request.data, dict) else request.data
+        if not isinstance(tree, list):
+            raise ParseError("Expected a list of components.")
+        return Response(replace_tree(self.get_object(), tree), status=200)
+
+    @action(detail=True)
+    def objects_before(self, request, pk=None):
+        """Returns the total number of objects before each component in the map,
+        keyed by component id."""
+        map = self.get_object()
+        counts = {}
+        total = 0
+        previous_index = previous_total = None
+        for pk, tree_index, child_count in ArrangementMapComponent.objects.filter(
+                map=map, tree_index__isnull=False).order_by('tree_index').values_list('pk', 'tree_index', 'child_count'):
+            if tree_index != previous_index:
+                previous_index, previous_total = tree_index, total
+            counts[pk] = previous_total
+            total += 1 + child_count
+        return Response({"counts": counts}, status=200)
 
     def get_serializer_class(self):
         if self.action == 'list':
             return ArrangementMapListSerializer
         return ArrangementMapSerializer
 
+    def get_renderers(self):
+        renderers = super(ArrangementMapViewset, self).get_renderers()
+        if self.action == 'retrieve':
+            renderers.append(CompactJSONRenderer())
+        return renderers
+
+    def get_serializer_context(self):
+        context = super(ArrangementMapViewset, self).get_serializer_context()
+        context['depth'] = get_depth(self.request)
+        return context
+
     def get_queryset(self):
-        return process_params(self)
+        queryset = process_params(self)
+        if self.action == 'retrieve':
+            queryset = queryset.select_related('snapshot')
+        return queryset
 
 
 class ArrangementMapComponentViewset(ModelViewSet):
@@ -109,29 +257,95 @@ class ArrangementMapComponentViewset(ModelViewSet):
     model = ArrangementMapComponent
     queryset = ArrangementMapComponent.objects.all().order_by('-modified')
 
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        """Deletes the component and its descendants, creating their tombstones
+        with a single insert and saving the map once."""
+        with batch_component_signals():
+            instance.delete()
+
     def get_serializer_class(self):
         if self.action == 'list':
             return ArrangementMapComponentListSerializer
         return ArrangementMapComponentSerializer
 
+    def retrieve(self, request, *args, **kwargs):
+        """Overrides default retrieve method to validate conditional requests.
+
+        Ancestors and children are part of the same map, so the component's
+        own `modified` time and that of its map are enough to tell whether
+        the response has changed.
+        """
+        modified = get_object_or_404(self.get_queryset().values_list('modified', 'map__modified'), pk=kwargs['pk'])
+        return conditional_response(
+            request, lambda: super(ArrangementMapComponentViewset, self).retrieve(request, *args, **kwargs),
+            max(modified), *modified)
+
+    def list(self, request, *args, **kwargs):
+        """Overrides default list method to validate conditional requests."""
+        latest = self.filter_queryset(self.get_queryset()).aggregate(modified=Max('modified'), count=Count('pk'))
+        return conditional_response(
+            request, lambda: super(ArrangementMapComponentViewset, self).list(request, *args, **kwargs),
+            latest['modified'], latest['count'])
+
     def get_queryset(self):
-        return process_params(self)
+        queryset = process_params(self)
+        if self.action == 'retrieve':
+            queryset = queryset.select_related('map').prefetch_related('children')
+        return queryset
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """Creates ArrangementMapComponents from a list.
+
+        Each component may include a `key`, which other components in the list
+        can use as their `parent_key` to refer to it as their parent.
+        """
+        serializer = ArrangementMapComponentBulkSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=201)
+
+    @action(detail=True)
+    def subtree(self, request, pk=None):
+        """Returns the component with its descendants nested within it, up to
+        `depth` levels below it (one by default).
+
+        Components whose children are left out are marked with `has_children`
+        and the number of their descendants, so clients can expand them later.
+        """
+        component = get_object_or_404(ArrangementMapComponent.objects.select_related('map'), pk=pk)
+        depth = get_depth(request) or 1
+        return conditional_response(
+            request,
+            lambda: Response(ArrangementMapComponentTreeSerializer(component, context={'depth': depth}).data),
+            component.map.modified)
 
     @action(detail=True)
     def objects_before(self, request, pk=None):
         """Returns the total number of objects before the target component."""
         obj = get_object_or_404(ArrangementMapComponent, pk=pk)
         try:
-            previous_components = ArrangementMapComponent.objects.filter(
-                map=obj.map, tree_index__lt=obj.tree_index)
-            count = len(previous_components)
-            if count:
-                count += previous_components.aggregate(Sum("child_count")).get("child_count__sum", 0)
-            return Response({"count": count}, status=200)
+            previous = ArrangementMapComponent.objects.filter(
+                map=obj.map_id, tree_index__lt=obj.tree_index).aggregate(
+                    components=Count('pk'), children=Coalesce(Sum('child_count'), 0))
+            return Response({"count": previous["components"] + previous["children"]}, status=200)
         except Exception as e:
             return Response(str(e), status=500)
 
 
+class JobViewset(RetrieveModelMixin, GenericViewSet):
+    """Job endpoints.
+
+    retrieve:
+        Returns the status, progress and result of a background Job,
+        identified by a primary key.
+    """
+    model = Job
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+
+
 class DeletedArrangementMapView(ListAPIView):
     """Returns deleted ArrangementMap and ArrangementMapComponent objects.
 
@@ -144,31 +358,114 @@ class DeletedArrangementMapView(ListAPIView):
     """
     model = DeletedArrangementMap
     serializer_class = DeletedArrangementMapSerializer
+    keyset_field = 'deleted'
 
     def get_queryset(self):
         deleted_since = int(self.request.query_params.get('deleted_since', 0))
         return DeletedArrangementMap.objects.filter(
             deleted__gte=make_aware(datetime.fromtimestamp(deleted_since))).order_by('-deleted')
 
+    def list(self, request, *args, **kwargs):
+        """Overrides default list method to validate conditional requests."""
+        latest = self.get_queryset().aggregate(deleted=Max('deleted'), count=Count('pk'))
+        return conditional_response(
+            request, lambda: super(DeletedArrangementMapView, self).list(request, *args, **kwargs),
+            latest['deleted'], latest['count'])
+
+
+class ChangeFeedView(APIView):
+    """Returns changes to ArrangementMap and ArrangementMapComponent objects,
+    in the order they were made.
+
+    Each change has a `sequence` number. The response includes a `next` link
+    which continues from the last change returned.
+
+    Params:
+        since (int): an optional sequence number; only changes after it are
+            returned.
+        limit (int): the maximum number of changes to return, up to
+            CHANGE_FEED_MAX_LIMIT.
+    """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = int(request.query_params.get('limit', api_settings.PAGE_SIZE))
+        except ValueError:
+            raise ParseError("`since` and `limit` must be integers.")
+        if limit < 1:
+            raise ParseError("`limit` must be a positive integer.")
+        limit = min(limit, settings.CHANGE_FEED_MAX_LIMIT)
+        changes = list(Change.objects.filter(sequence__gt=since).order_by('sequence')[:limit + 1])
+        next_link = None
+        if len(changes) > limit:
+            changes = changes[:limit]
+            next_link = replace_query_param(request.build_absolute_uri(), 'since', changes[-1].sequence)
+        return Response({"next": next_link, "results": ChangeSerializer(changes, many=True).data}, status=200)
+
+
+class ExportView(APIView):
+    """Streams all published ArrangementMaps as newline-delimited JSON.
+
+    Each line contains a map and its full component tree, in the same form as
+    the map detail view. Under ASGI the response is streamed from an async
+    iterator, as Django buffers synchronous iterators there.
+
+    Params:
+        modified_since (timestamp): an optional argument which limits return to
+            maps modified since.
+    """
+
+    def get(self, request, *args, **kwargs):
+        modified_since = make_aware(datetime.fromtimestamp(int(request.query_params.get('modified_since', 0))))
+        export = aexport_maps if settings.ASGI else export_maps
+        return StreamingHttpResponse(export(modified_since), content_type='application/x-ndjson')
 
-class ResourceFetcherView(APIView):
+
+class ResourceFetcherView(View):
     """Fetches a resource from ArchivesSpace which matches a given ID.
 
+    Resources are cached, and the `X-Cache` response header reports whether
+    the cached copy was used.
+
     Params:
         resource_id (int): an ArchivesSpace identifier for a resource record.
+        refresh: if present, bypasses the cache.
     """
 
     def get(self, request, *args, **kwargs):
         try:
-            self.repo = ASpace(baseurl=settings.ASPACE['baseurl'],
-                               username=settings.ASPACE['username'],
-                               password=settings.ASPACE['password']).repositories(settings.ASPACE['repo_id'])
-            resource = self.repo.resources(kwargs.get('resource_id'))
-            if isinstance(resource, JSONModelObject):
-                return Response(resource.json(), status=200)
-            return Response(resource['error'], status=404)
+            return self.get_response(*fetch_resource(kwargs.get('resource_id'), refresh='refresh' in request.GET))
         except Exception as e:
-            return Response(str(e), status=500)
+            return JsonResponse(str(e), status=500, safe=False)
+
+    def get_response(self, status, resource, cache_status):
+        if status == 200:
+            response = JsonResponse(resource, status=200)
+        else:
+            response = JsonResponse(resource['error'], status=404, safe=False)
+        response['X-Cache'] = cache_status
+        return response
+
+
+class AsyncResourceFetcherView(ResourceFetcherView):
+    """Asynchronous version of ResourceFetcherView, which is routed instead
+    when the application is served with ASGI, so that requests waiting on
+    ArchivesSpace do not hold a worker."""
+
+    async def get(self, request, *args, **kwargs):
+        try:
+            return self.get_response(
+                *await afetch_resource(kwargs.get('resource_id'), refresh='refresh' in request.GET))
+        except Exception as e:
+            return JsonResponse(str(e), status=500, safe=False)
+
+
+class ResourceCacheStatsView(APIView):
+    """Returns hit, revalidated hit and miss counts for the resource cache."""
+
+    def get(self, request, *args, **kwargs):
+        return Response(resource_cache_stats(), status=200)
 
 
 class FindByURISchema(AutoSchema):
@@ -192,6 +489,62 @@ class FindByURIView(ListAPIView):
     def get_queryset(self):
         try:
             uri = self.request.GET["uri"]
-            return ArrangementMapComponent.objects.filter(archivesspace_uri=uri)
+            return ArrangementMapComponent.objects.filter(
+                archivesspace_uri=uri).select_related('map').prefetch_related('children')
         except KeyError:
             raise ParseError("Required URL parameter `uri` missing.")
+
+
+class FindByURIBatchSchema(AutoSchema):
+    """Returns a custom operationId."""
+
+    def get_operation_id(self, path, method):
+        return 'findByUriBatch'
+
+
+class FindByURIBatchView(APIView):
+    """Returns ArrangementMapComponent objects matching any of a list of
+    ArchivesSpace URIs, grouped by URI.
+
+    URIs are submitted either as repeated `uri` URL parameters or, for longer
+    lists, as a POST body containing a list of URIs (on its own or as `uris`).
+    Every submitted URI is a key of the response, with an empty list if no
+    components match it.
+
+    Params:
+        uri (str): an ArchivesSpace URI
+    """
+    schema = FindByURIBatchSchema()
+    replica_safe_methods = ('POST',)
+
+    def get(self, request, *args, **kwargs):
+        return self.find(request.query_params.getlist('uri'))
+
+    def post(self, request, *args, **kwargs):
+        uris = request.data.get('uris') if isinstance(request.data, dict) else request.data
+        if not isinstance(uris, list) or not all(isinstance(uri, str) for uri in uris):
+            raise ParseError("Expected a list of URIs.")
+        return self.find(uris)
+
+    def find(self, uris):
+        if not uris:
+            raise ParseError("At least one URI is required.")
+        if len(uris) > settings.FIND_BY_URI_MAX_URIS:
+            raise ParseError(f"No more than {settings.FIND_BY_URI_MAX_URIS} URIs can be submitted at once.")
+        components = ArrangementMapComponent.objects.filter(
+            archivesspace_uri__in=set(uris)).select_related('map').prefetch_related('children')
+        results = {uri: [] for uri in uris}
+        for component in ArrangementMapComponentSerializer(components, many=True).data:
+            results[component['archivesspace_uri']].append(component)
+        return Response(results, status=200)
+
+
+class MetricsView(View):
+    """Returns request metrics, and the logins and connection reuse of the
+    ArchivesSpace client, in the Prometheus text exposition format.
+
+    Metrics are collected per process, so each worker process reports its own.
+    """
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(render_metrics(client_metrics()), content_type='text/plain; version=0.0.4; charset=utf-8')